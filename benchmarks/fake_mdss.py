@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Stand-in for the mdss command, for benchmarking mdssdiff without access to
+a real mass data store. It serves dmls -l listings of a synthetic directory
+tree and pretends to put and get files, and is configured with environment
+variables:
+
+    FAKE_MDSS_TREE       root:depth:fanout:files, the path of the top of the
+                         tree, how many levels of directories it has below
+                         the top, how many subdirectories each directory has
+                         and how many files each directory has
+    FAKE_MDSS_LATENCY    seconds to wait before running any command (0)
+    FAKE_MDSS_BANDWIDTH  bytes per second at which put and get copy files,
+                         or 0 for no limit (0)
+    FAKE_MDSS_OFFLINE    fraction of files which are only on tape (0)
+    FAKE_MDSS_LOG        file to which the name of each command run is
+                         appended, to count calls
+
+Directories are called d0, d1, ... and files f0.nc, f1.nc, ... Sizes and
+DMF states are derived from the path of each file, so every run sees the
+same tree. All files and directories have the modification time given by
+MTIME.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import zlib
+
+MTIME = (2015, 11, 9, 12, 40)
+
+_dirline = 'drwxr-sr-x 2 abc123 a00 4096 {:04d}-{:02d}-{:02d} {:02d}:{:02d} (REG) {}'
+_fileline = '-rw-r--r-- 1 abc123 a00 {} {:04d}-{:02d}-{:02d} {:02d}:{:02d} ({}) {}'
+
+class Tree(object):
+    """The synthetic directory tree described by FAKE_MDSS_TREE"""
+
+    def __init__(self, spec, offline=0.):
+        root, depth, fanout, files = spec.rsplit(':', 3)
+        self.root = os.path.normpath(root)
+        self.depth = int(depth)
+        self.fanout = int(fanout)
+        self.files = int(files)
+        self.offline = offline
+
+    def level(self, path):
+        """Return the depth of directory path below the root, -1 for
+        ancestors of the root, or None if it is not a directory"""
+        path = os.path.normpath(path)
+        if path == self.root:
+            return 0
+        if (self.root + '/').startswith(path + '/') or path == '.':
+            return -1
+        if not path.startswith(self.root + '/'):
+            return None
+        parts = path[len(self.root)+1:].split('/')
+        if len(parts) > self.depth:
+            return None
+        for part in parts:
+            if not (part.startswith('d') and part[1:].isdigit() and int(part[1:]) < self.fanout):
+                return None
+        return len(parts)
+
+    def size(self, path):
+        return zlib.crc32(path.encode('utf-8')) & 0xfffff
+
+    def dmstate(self, path):
+        if (zlib.crc32(path.encode('utf-8')) & 0xffff) < self.offline * 0x10000:
+            return 'OFL'
+        return 'DUL'
+
+    def isfile(self, path):
+        dname, name = os.path.split(os.path.normpath(path))
+        level = self.level(dname)
+        return (level is not None and level >= 0 and name.startswith('f') and name.endswith('.nc')
+                and name[1:-3].isdigit() and int(name[1:-3]) < self.files)
+
+    def dirs(self, path):
+        level = self.level(path)
+        if level == -1:
+            rest = os.path.relpath(self.root, os.path.normpath(path))
+            return [rest.split('/')[0]]
+        return ['d{}'.format(i) for i in range(self.fanout)] if level < self.depth else []
+
+    def filenames(self, path):
+        return ['f{}.nc'.format(i) for i in range(self.files)] if self.level(path) >= 0 else []
+
+    def dirline(self, name):
+        return _dirline.format(*(MTIME + (name,)))
+
+    def fileline(self, path, name):
+        return _fileline.format(*((self.size(path),) + MTIME + (self.dmstate(path), name)))
+
+    def listdir(self, path):
+        lines = ['total 0']
+        lines.extend(self.dirline(d) for d in self.dirs(path))
+        lines.extend(self.fileline(os.path.join(path, f), f) for f in self.filenames(path))
+        return lines
+
+def dmls(tree, opts, paths):
+    recursive = any('R' in opt for opt in opts)
+    directory = any('d' in opt for opt in opts)
+    status = 0
+    out = []
+    for path in paths:
+        if tree.level(path) is not None:
+            if directory:
+                out.append(tree.dirline(path))
+            elif recursive:
+                stack = [path]
+                while stack:
+                    dname = stack.pop()
+                    if out:
+                        out.append('')
+                    out.append(dname + ':')
+                    out.extend(tree.listdir(dname))
+                    stack.extend(os.path.join(dname, d) for d in reversed(tree.dirs(dname)))
+            else:
+                out.extend(tree.listdir(path))
+        elif tree.isfile(path):
+            out.append(tree.fileline(path, path))
+        else:
+            print('dmls: cannot access {}: No such file or directory'.format(path), file=sys.stderr)
+            status = 2
+    if out:
+        print('\n'.join(out))
+    return status
+
+def copy(nbytes, bandwidth):
+    if bandwidth > 0:
+        time.sleep(nbytes / float(bandwidth))
+
+def put(tree, paths, bandwidth):
+    for path in paths[:-1]:
+        if not os.path.isfile(path):
+            print('put: {} not found'.format(path), file=sys.stderr)
+            return 1
+        copy(os.path.getsize(path), bandwidth)
+    return 0
+
+def get(tree, paths, bandwidth):
+    target = paths[-1]
+    for path in paths[:-1]:
+        if not tree.isfile(path):
+            print('get: {} not found'.format(path), file=sys.stderr)
+            return 1
+        nbytes = tree.size(os.path.normpath(path))
+        copy(nbytes, bandwidth)
+        dest = os.path.join(target, os.path.basename(path)) if os.path.isdir(target) else target
+        with open(dest, 'wb') as fh:
+            fh.truncate(nbytes)
+    return 0
+
+def main(argv):
+    args = list(argv)
+    if args[:1] == ['-P']:
+        args = args[2:]
+    if not args:
+        print('usage: mdss [-P project] command [options] [paths]', file=sys.stderr)
+        return 2
+    cmd, rest = args[0], args[1:]
+    opts = [a for a in rest if a.startswith('-')]
+    paths = [a for a in rest if not a.startswith('-')]
+
+    log = os.environ.get('FAKE_MDSS_LOG')
+    if log:
+        with open(log, 'a') as fh:
+            fh.write(cmd + '\n')
+
+    latency = float(os.environ.get('FAKE_MDSS_LATENCY', 0))
+    if latency > 0:
+        time.sleep(latency)
+
+    tree = Tree(os.environ.get('FAKE_MDSS_TREE', 'fake:1:1:1'),
+                offline=float(os.environ.get('FAKE_MDSS_OFFLINE', 0)))
+    bandwidth = float(os.environ.get('FAKE_MDSS_BANDWIDTH', 0))
+
+    if cmd == 'dmls':
+        return dmls(tree, opts, paths)
+    elif cmd == 'put':
+        return put(tree, paths, bandwidth)
+    elif cmd == 'get':
+        return get(tree, paths, bandwidth)
+    elif cmd in ('mkdir', 'rm', 'rmdir', 'dmget'):
+        return 0
+    print('mdss: unknown command {}'.format(cmd), file=sys.stderr)
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Benchmarks of mdssdiff against the stand-in mdss in fake_mdss.py, which is
+put first on $PATH. A local copy of the synthetic tree is made in a
+temporary directory, with a fraction of the files left out so that there are
+differences to find, and each scenario is timed in turn. For each one the
+wall time, the number of mdss commands run and the peak memory allocated by
+Python (not available on Python 2) are reported, e.g.
+
+    python benchmarks/run.py --depth 3 --fanout 4 --files 50 --latency 0.05
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mdssdiff.mdsspath as mdsspath
+import mdssdiff.mdssdiff as mdssdiff
+import mdssdiff.transfer as transfer
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+# Lines of listing a second the parser should manage
+_parse_target = 100000
+
+# Scenarios whose speed is the point, which are run without tracing memory
+# as that slows them several times over
+_untraced = ('parse',)
+
+prefix = 'archive'
+root = 'bench'
+project = 'bench'
+
+def setup(args, workdir):
+    """Put the stand-in mdss on $PATH, configure it and make the local tree
+    in workdir"""
+    bindir = os.path.join(workdir, 'bin')
+    os.makedirs(bindir)
+    wrapper = os.path.join(bindir, 'mdss')
+    with open(wrapper, 'w') as fh:
+        fh.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(_here, 'fake_mdss.py')))
+    os.chmod(wrapper, 0o755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_MDSS_TREE'] = '{}:{}:{}:{}'.format(os.path.join(prefix, root), args.depth, args.fanout, args.files)
+    os.environ['FAKE_MDSS_LATENCY'] = str(args.latency)
+    os.environ['FAKE_MDSS_BANDWIDTH'] = str(args.bandwidth)
+    os.environ['FAKE_MDSS_OFFLINE'] = str(args.offline)
+    os.environ['FAKE_MDSS_LOG'] = os.path.join(workdir, 'calls.log')
+
+    sys.path.insert(0, _here)
+    import fake_mdss
+    tree = fake_mdss.Tree(os.environ['FAKE_MDSS_TREE'])
+    mtime = time.mktime(fake_mdss.MTIME + (0, 0, 0, -1))
+
+    # Make the local tree, leaving out every nth file
+    skip = int(1 / args.missing) if args.missing > 0 else 0
+    nfiles = 0
+    files = []
+    os.chdir(workdir)
+    stack = [root]
+    while stack:
+        dname = stack.pop()
+        rdname = os.path.join(prefix, dname)
+        os.makedirs(dname)
+        for name in tree.filenames(rdname):
+            nfiles += 1
+            files.append(os.path.join(dname, name))
+            if skip and nfiles % skip == 0:
+                continue
+            path = os.path.join(dname, name)
+            with open(path, 'wb') as fh:
+                fh.truncate(tree.size(os.path.join(rdname, name)))
+            os.utime(path, (mtime, mtime))
+        stack.extend(os.path.join(dname, d) for d in tree.dirs(rdname))
+    return files
+
+def ncalls():
+    try:
+        with open(os.environ['FAKE_MDSS_LOG']) as fh:
+            return sum(1 for _ in fh)
+    except IOError:
+        return 0
+
+def measure(name, func, memory=True):
+    """Run func and return a dict of its wall time, number of mdss calls and
+    peak Python memory in bytes, unless memory is False, along with any other
+    measurements func returns as a dict"""
+    mdsspath._mtime_cache.clear()
+    calls = ncalls()
+    memory = memory and tracemalloc is not None
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        extra = func()
+    finally:
+        elapsed = time.time() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    result = {'scenario': name, 'wall': elapsed, 'calls': ncalls() - calls, 'peak': peak}
+    if isinstance(extra, dict):
+        result.update(extra)
+    return result
+
+def parse_throughput(nlines):
+    """
+    Return the number of lines of listing parsed per second, for a synthetic
+    listing of nlines files with a realistic spread of timestamps
+    """
+    lines = ['-rw-r--r-- 1 abc123 a00 {} 2015-11-{:02d} {:02d}:{:02d} (DUL) file{}.nc'.format(
+             i*7, i%28+1, i%24, i%60, i) for i in range(nlines)]
+    mdsspath._mtime_cache.clear()
+    start = time.time()
+    mdsspath._parse_entries(lines)
+    return nlines / max(time.time() - start, 1e-9)
+
+def scenarios(args, files):
+    """Return a list of (name, function) for each benchmark"""
+    rtop = os.path.join(prefix, root)
+    uploads = []
+
+    def put():
+        engine = transfer.TransferEngine(prefix, project, jobs=args.jobs, batch_size=args.batch_size)
+        engine.put(uploads)
+
+    def get():
+        cwd = os.getcwd()
+        os.chdir('download')
+        try:
+            engine = transfer.TransferEngine(prefix, project, jobs=args.jobs, batch_size=args.batch_size)
+            engine.get(files[:args.transfer_files])
+        finally:
+            os.chdir(cwd)
+
+    # Files to put, in a directory which does not exist remotely
+    os.makedirs('upload')
+    os.makedirs('download')
+    for i in range(args.transfer_files):
+        uploads.append(os.path.join('upload', 'u{}.nc'.format(i)))
+        with open(uploads[-1], 'wb') as fh:
+            fh.truncate(1024)
+
+    return [
+        ('walk', lambda: list(mdsspath.walk(rtop, project))),
+        ('walk-jobs', lambda: list(mdsspath.walk(rtop, project, jobs=args.jobs))),
+        ('walk-recursive-ls', lambda: list(mdsspath.walk(rtop, project, recursive_ls=True))),
+        ('diffdir', lambda: mdssdiff.diffdir(prefix, root, project, recursive=True)),
+        ('diffdir-jobs', lambda: mdssdiff.diffdir(prefix, root, project, recursive=True,
+                                                  jobs=args.jobs, local_jobs=args.jobs)),
+        ('diffdir-recursive-ls', lambda: mdssdiff.diffdir(prefix, root, project, recursive=True,
+                                                          recursive_ls=True)),
+        ('put', put),
+        ('get', get),
+        ('parse', lambda: {'lines_per_second': parse_throughput(args.parse_lines)}),
+    ]
+
+def parse_args(args):
+
+    parser = argparse.ArgumentParser(description="Benchmark mdssdiff against a stand-in mdss")
+    parser.add_argument("--depth", help="Levels of directories below the top of the tree (default 2)", type=int, default=2)
+    parser.add_argument("--fanout", help="Number of subdirectories of each directory (default 4)", type=int, default=4)
+    parser.add_argument("--files", help="Number of files in each directory (default 100)", type=int, default=100)
+    parser.add_argument("--latency", help="Seconds each mdss command takes to start (default 0.05)", type=float, default=0.05)
+    parser.add_argument("--bandwidth", help="Bytes per second copied by mdss put and get, 0 for no limit (default 0)", type=float, default=0)
+    parser.add_argument("--offline", help="Fraction of remote files which are only on tape (default 0)", type=float, default=0)
+    parser.add_argument("--missing", help="Fraction of files missing from the local tree (default 0.01)", type=float, default=0.01)
+    parser.add_argument("-j","--jobs", help="Concurrency used by the scenarios which have it (default 8)", type=int, default=8)
+    parser.add_argument("-b","--batch-size", help="Batch size for the put and get scenarios (default 1)", type=int, default=1)
+    parser.add_argument("--transfer-files", help="Number of files copied by the put and get scenarios (default 50)", type=int, default=50)
+    parser.add_argument("--parse-lines", help="Number of lines of listing parsed by the parse scenario (default 100000)", type=int, default=100000)
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    parser.add_argument("scenarios", help="Scenarios to run (default all)", nargs='*')
+
+    return parser.parse_args(args)
+
+def main(args):
+
+    cwd = os.getcwd()
+    json_file = None if args.json is None else os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix='mdssdiff-bench-')
+    results = []
+    try:
+        files = setup(args, workdir)
+        print("{} directories, {} files, {}s latency".format(
+            sum(args.fanout**i for i in range(args.depth+1)), len(files), args.latency))
+        print("{:<22} {:>9} {:>7} {:>10}".format('scenario', 'wall (s)', 'calls', 'peak (MiB)'))
+        for name, func in scenarios(args, files):
+            if args.scenarios and name not in args.scenarios:
+                continue
+            result = measure(name, func, memory=name not in _untraced)
+            results.append(result)
+            peak = '-' if result['peak'] is None else '{:.1f}'.format(result['peak'] / 1048576.)
+            print("{:<22} {:>9.2f} {:>7} {:>10}".format(name, result['wall'], result['calls'], peak))
+            if 'lines_per_second' in result:
+                rate = result['lines_per_second']
+                print("  {:.0f} lines/s parsed{}".format(rate, '' if rate >= _parse_target else
+                                                         ', below the target of {}'.format(_parse_target)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    if json_file is not None:
+        with open(json_file, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 from __future__ import print_function
+import sys
 import pytest
 
 # Add test fixtures here so they are accessible from doctests
+
+# The asyncio engine needs async/await, which is a syntax error before 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore += ['mdssdiff/aiomdss.py', 'test/test_aiomdss.py']
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import time
+import shlex
+import asyncio
+import itertools
+import subprocess
+from fnmatch import fnmatch
+
+import mdssdiff.mdsspath as mdsspath
+import mdssdiff.localpath as localpath
+import mdssdiff.checksum as checksum
+from mdssdiff.mdssdiff import (Difference, MISSING_LOCAL, MISSING_REMOTE,
+                               MISMATCHED_SIZE, MISMATCHED_TIME)
+
+class Session(object):
+    """
+    Runs mdss commands for project from asyncio, so that many can be in
+    flight at once from a single thread. At most limit commands run at the
+    same time, and any command which takes longer than timeout seconds, or
+    whose caller is cancelled, is killed. The commands are those used by
+    mdsspath, along with its listing cache and metrics if they are set.
+    Requires Python 3.5 or later, e.g.
+
+        session = aiomdss.Session(project, limit=64, timeout=600)
+        loop = asyncio.get_event_loop()
+        diffs = loop.run_until_complete(session.diffdir(prefix, 'data', recursive=True))
+    """
+
+    def __init__(self, project, limit=16, timeout=None, verbose=0):
+        self.project = project
+        self.limit = limit
+        self.timeout = timeout
+        self.verbose = verbose
+        # Made on first use, so that it belongs to the running event loop
+        self._semaphore = None
+        # Listings being run, keyed by path and options
+        self._inflight = {}
+
+    def _cmd(self, template, *args):
+        cmd = shlex.split(template.format(self.project))
+        cmd.extend(args)
+        if self.verbose > 1: print(" ".join(cmd))
+        return cmd
+
+    async def _run(self, kind, cmd, nbytes=None):
+        """
+        Run an mdss command and return its output, raising CalledProcessError
+        if it fails and asyncio.TimeoutError if it takes longer than timeout.
+        Commands are recorded in mdsspath.metrics as by mdsspath._run
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        async with self._semaphore:
+            start = time.time()
+            try:
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE,
+                                                            stderr=subprocess.STDOUT)
+            except Exception:
+                mdsspath._record(kind, start, -1)
+                raise
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+            except BaseException:
+                # Timed out or cancelled
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                mdsspath._record(kind, start, -1)
+                raise
+        if proc.returncode != 0:
+            mdsspath._record(kind, start, proc.returncode)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        if mdsspath.metrics is not None:
+            try:
+                nbytes = len(output) if nbytes is None else nbytes()
+            except OSError:
+                nbytes = 0
+            mdsspath._record(kind, start, 0, nbytes)
+        return output
+
+    async def ls(self, path, options=None):
+        """
+        Return the listing of path, which is empty if it could not be listed.
+        Concurrent requests for the same listing share a single command
+        """
+        if mdsspath.listing_cache is not None:
+            output = mdsspath.listing_cache.get(self.project, path, options)
+            if output is not None:
+                return output
+        key = (path, tuple(options or ()))
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._ls(path, options))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A caller which is cancelled does not cancel the listing for the others
+        return await asyncio.shield(task)
+
+    async def _ls(self, path, options):
+        cmd = self._cmd(mdsspath._mdss_ls_cmd, *(list(options or ()) + [path]))
+        try:
+            output = (await self._run('ls', cmd)).decode('utf-8')
+        except (subprocess.CalledProcessError, OSError):
+            return ''
+        if mdsspath.listing_cache is not None:
+            mdsspath.listing_cache.put(self.project, path, output, options)
+        return output
+
+    async def scandir(self, path):
+        """Return a list of the names of subdirectories of path and a list of
+        FileEntry for the non-directories, as mdsspath.mdss_scandir"""
+        return mdsspath._parse_entries((await self.ls(path)).splitlines())
+
+    async def isdir(self, path):
+        return (await self.ls(path, ['-d']))[:1] == 'd'
+
+    async def walk(self, top):
+        """Return a list of (root, dirs, files) for top and every directory
+        below it, as yielded by mdsspath.walk_entries. All the
+        subdirectories of a directory are listed at the same time"""
+        dirs, files = await self.scandir(top)
+        result = [(top, dirs, files)]
+        for listing in await _gather(self.walk(os.path.join(top, d)) for d in dirs):
+            result.extend(listing)
+        return result
+
+    async def mkdir(self, dir):
+        try:
+            await self._run('mkdir', self._cmd(mdsspath._mdss_mkdir_cmd, dir))
+        finally:
+            mdsspath._invalidate(dir, self.project)
+
+    async def makedirs(self, prefix, dirs, known_dirs=None):
+        """Make sure all of dirs exist on mdss, along with any directories
+        between them and prefix, as mdsspath.make_remote_dirs. Directories
+        at the same depth are checked and made at the same time"""
+        if known_dirs is None:
+            known_dirs = set()
+        created = set()
+
+        async def make(dir):
+            # No need to check for a directory whose parent was just created
+            if os.path.dirname(dir) in created or not await self.isdir(dir):
+                await self.mkdir(dir)
+                created.add(dir)
+            known_dirs.add(dir)
+
+        needed = mdsspath._needed_dirs(prefix, dirs, known_dirs)
+        for _, level in itertools.groupby(needed, key=lambda d: d.count('/')):
+            await _gather(make(dir) for dir in level)
+        return known_dirs
+
+    async def put(self, path, rpath):
+        """Copy the local file path to rpath on mdss, whose directory must
+        exist. Raises an exception on failure"""
+        try:
+            await self._run('put', self._cmd(mdsspath._mdss_put_cmd, path, rpath),
+                            lambda: os.path.getsize(path))
+        finally:
+            mdsspath._invalidate(rpath, self.project)
+
+    async def get(self, rpath, path):
+        """Copy rpath on mdss to the local file path. Raises an exception on
+        failure"""
+        await self._run('get', self._cmd(mdsspath._mdss_get_cmd, rpath, path),
+                        lambda: os.path.getsize(path))
+
+    async def remote_put(self, prefix, files, known_dirs=None):
+        """
+        Copy files to the same relative paths under prefix, making any
+        remote directories needed first, and return a list of (file,
+        exception) for the files which could not be copied
+        """
+        rdirs = set(os.path.dirname(os.path.join(prefix, file)) for file in files)
+        await self.makedirs(prefix, rdirs, known_dirs)
+        return await self._copy(files, lambda file: self.put(file, os.path.join(prefix, file)))
+
+    async def remote_get(self, prefix, files):
+        """
+        Copy files from the same relative paths under prefix, making any
+        local directories needed first, and return a list of (file,
+        exception) for the files which could not be copied
+        """
+        for dir in set(os.path.dirname(file) for file in files):
+            if dir:
+                mdsspath.mkdir_p(dir)
+        return await self._copy(files, lambda file: self.get(os.path.join(prefix, file), file))
+
+    async def _copy(self, files, copy):
+        async def copy_one(file):
+            try:
+                await copy(file)
+            except (subprocess.CalledProcessError, OSError, asyncio.TimeoutError) as err:
+                return file, err
+        return [failed for failed in await _gather(copy_one(file) for file in files) if failed is not None]
+
+    async def diffdir(self, prefix, directory, recursive=False, match=None):
+        """
+        Compare the local directory with the same path under prefix on mdss,
+        and return the same lists of files missing locally and remotely and
+        dicts of mismatched sizes and times as mdssdiff.diffdir. Remote
+        directories are listed at the same time, and the local tree is
+        walked in a thread so as not to block the event loop
+        """
+        loop = asyncio.get_event_loop()
+        local = await loop.run_in_executor(None, _localtree, directory, recursive)
+
+        if directory in local:
+            diffs = await self._compare(prefix, directory, local, recursive, match, True)
+        else:
+            diffs = await self._remoteonly(prefix, directory, recursive, match)
+
+        missinglocal = []; missingremote = []; mismatchedsizes = {}; mismatchedtimes = {}
+        for diff in diffs:
+            if diff.kind == MISSING_LOCAL:
+                missinglocal.append(diff.file)
+            elif diff.kind == MISSING_REMOTE:
+                missingremote.append(diff.file)
+            elif diff.kind == MISMATCHED_SIZE:
+                mismatchedsizes[diff.file] = (diff.local,diff.remote)
+            elif diff.kind == MISMATCHED_TIME:
+                mismatchedtimes[diff.file] = (diff.local,diff.remote)
+
+        return(missinglocal, missingremote, mismatchedsizes, mismatchedtimes)
+
+    async def _compare(self, prefix, dname, local, recursive, match, remote):
+        """Return a list of the Differences in local directory dname and
+        below it. remote is False if it is known not to exist on mdss"""
+        dirnames, filenames, entries = local[dname]
+        rdname = os.path.join(prefix,dname)
+        rdirnames, rfiles = (await self.scandir(rdname)) if remote else ([], [])
+        remoteset = dict((f.name,f) for f in rfiles)
+        remoteset.pop(checksum.SIDECAR, None)
+
+        diffs = []
+        for file in filenames:
+            if file == checksum.SIDECAR:
+                continue
+            localfile = os.path.join(dname,file)
+            if match is not None and not fnmatch(localfile,match):
+                remoteset.pop(file, None)
+            elif file in remoteset:
+                lentry, rentry = entries[file], remoteset.pop(file)
+                if lentry.size != rentry.size:
+                    diffs.append(Difference(MISMATCHED_SIZE,localfile,lentry.size,rentry.size))
+                if lentry.mtime != rentry.mtime:
+                    diffs.append(Difference(MISMATCHED_TIME,localfile,lentry.datetime,rentry.datetime))
+            else:
+                diffs.append(Difference(MISSING_REMOTE,localfile,entries[file].size,None))
+        for file, rentry in remoteset.items():
+            if match is None or fnmatch(file,match):
+                diffs.append(Difference(MISSING_LOCAL,os.path.join(dname,file),None,rentry.size))
+
+        if recursive:
+            # Links to directories are in dirnames but were not walked, so as
+            # with iterdiff they are treated as missing locally
+            rdirset = set(rdirnames)
+            subdirs = [self._compare(prefix, os.path.join(dname,d), local, recursive, match, d in rdirset)
+                       for d in dirnames if os.path.join(dname,d) in local]
+            subdirs.extend(self._remoteonly(prefix, os.path.join(dname,d), recursive, match)
+                           for d in rdirnames if os.path.join(dname,d) not in local)
+            for subdiffs in await _gather(subdirs):
+                diffs.extend(subdiffs)
+        return diffs
+
+    async def _remoteonly(self, prefix, ldirectory, recursive, match):
+        """Return a Difference for every file in and below a directory which
+        only exists on mdss"""
+        rtop = os.path.join(prefix,ldirectory)
+        if recursive:
+            listings = await self.walk(rtop)
+        else:
+            listings = [(rtop,) + tuple(await self.scandir(rtop))]
+        diffs = []
+        for rdname, _, rfiles in listings:
+            for f in rfiles:
+                if f.name == checksum.SIDECAR or (match is not None and not fnmatch(f.name,match)):
+                    continue
+                diffs.append(Difference(MISSING_LOCAL,os.path.join(os.path.relpath(rdname,prefix),f.name),None,f.size))
+        return diffs
+
+def _localtree(directory, recursive):
+    """Return a dict of (dirnames, filenames, entries) for each local
+    directory compared, keyed by path"""
+    walker = localpath.walk(directory)
+    if not recursive:
+        walker = itertools.islice(walker, 1)
+    return dict((dname, (dirnames, filenames, entries))
+                for dname, dirnames, filenames, entries in walker)
+
+async def _gather(aws):
+    """Run awaitables at the same time and return their results in order.
+    If any of them fails, or the caller is cancelled, the others are
+    cancelled before the exception is raised"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
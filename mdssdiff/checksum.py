@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import io
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import mdssdiff.mdsspath as mdsspath
+import mdssdiff.listcache as listcache
+
+# Name of the file in each remote directory holding the checksums of the
+# files in it, in the format written by sha256sum. Not a dotfile, so that
+# listings show which directories have one
+SIDECAR = 'mdssdiff.sha256'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev    INTEGER NOT NULL,
+    inode  INTEGER NOT NULL,
+    size   INTEGER NOT NULL,
+    mtime  REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (dev, inode, size, mtime)
+);
+"""
+
+def default_path():
+    """Return the default location of the hash cache, next to the listing
+    cache"""
+    return os.path.join(os.path.dirname(listcache.default_path()), 'hashes.sqlite')
+
+def sha256(path, blocksize=1<<20):
+    """Return the SHA-256 checksum of the file path as a hex string"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def parse_sidecar(text):
+    """
+    Return a dict of checksums keyed by file name from the contents of a
+    checksum file
+
+    >>> parse_sidecar('{}  data.nc\\n'.format('0'*64)) == {'data.nc': '0'*64}
+    True
+    """
+    hashes = {}
+    for line in text.splitlines():
+        checksum, sep, name = line.partition('  ')
+        if sep:
+            hashes[name] = checksum
+    return hashes
+
+def format_sidecar(hashes):
+    """Return the contents of a checksum file for a dict of checksums"""
+    return ''.join('{}  {}\n'.format(hashes[name], name) for name in sorted(hashes))
+
+class HashCache(object):
+    """
+    Persistent cache of file checksums, stored in a SQLite database and
+    keyed by device, inode, size and modification time, so that files which
+    have not changed are never read again.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = default_path()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_schema)
+
+    def get(self, st):
+        """Return the cached checksum of the file with stat result st, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT sha256 FROM hashes WHERE dev = ? AND inode = ? AND "
+                                   "size = ? AND mtime = ?",
+                                   (st.st_dev, st.st_ino, st.st_size, st.st_mtime)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, items):
+        """Add a list of (stat result, checksum) to the cache"""
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                                 [(st.st_dev, st.st_ino, st.st_size, st.st_mtime, checksum)
+                                  for st, checksum in items])
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class Checksums(object):
+    """
+    Calculate checksums of local files, using up to jobs processes and the
+    HashCache cache if given, and read and write the checksum files kept in
+    each remote directory. The checksums read from or written to the last
+    stored_max remote directories are kept, so they are not read again.
+    """
+
+    stored_max = 10000
+
+    def __init__(self, project, cache=None, jobs=1, verbose=0):
+        self.project = project
+        self.cache = cache
+        self.jobs = jobs
+        self.verbose = verbose
+        self._pool = None
+        self._stored = OrderedDict()
+        self._lock = threading.Lock()
+
+    def local(self, files):
+        """Return a dict of the checksums of local files keyed by path"""
+        hashes, missing = {}, []
+        for file in files:
+            st = os.stat(file)
+            checksum = None if self.cache is None else self.cache.get(st)
+            if checksum is None:
+                missing.append((file, st))
+            else:
+                hashes[file] = checksum
+        if not missing:
+            return hashes
+        if self.jobs > 1 and len(missing) > 1:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = multiprocessing.Pool(self.jobs)
+                pool = self._pool
+            checksums = pool.map(sha256, [file for file, _ in missing])
+        else:
+            checksums = [sha256(file) for file, _ in missing]
+        if self.verbose > 1: print("Calculated {} checksums".format(len(missing)))
+        if self.cache is not None:
+            self.cache.put([(st, checksum) for (_, st), checksum in zip(missing, checksums)])
+        hashes.update((file, checksum) for (file, _), checksum in zip(missing, checksums))
+        return hashes
+
+    def remote(self, rdir, exists=True):
+        """Return a dict of the checksums stored in remote directory rdir
+        keyed by file name, which is empty if there are none. exists is
+        False if a listing of rdir showed it has no checksum file, in which
+        case none is fetched"""
+        with self._lock:
+            hashes = self._stored.get(rdir)
+        if hashes is not None:
+            return dict(hashes)
+        hashes = self._fetch(rdir) if exists else {}
+        self._keep(rdir, hashes)
+        return dict(hashes)
+
+    def _fetch(self, rdir):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tmpfile = os.path.join(tmpdir, SIDECAR)
+            try:
+                mdsspath.get_path(os.path.join(rdir, SIDECAR), tmpfile, self.project, self.verbose)
+            except Exception:
+                return {}
+            with io.open(tmpfile, encoding='utf-8') as fh:
+                return parse_sidecar(fh.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _keep(self, rdir, hashes):
+        with self._lock:
+            self._stored.pop(rdir, None)
+            self._stored[rdir] = hashes
+            while len(self._stored) > self.stored_max:
+                self._stored.popitem(last=False)
+
+    def store(self, rdir, hashes):
+        """Add checksums keyed by file name to those stored in remote
+        directory rdir, which are only fetched if they have not already
+        been read"""
+        stored = self.remote(rdir)
+        stored.update(hashes)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tmpfile = os.path.join(tmpdir, SIDECAR)
+            with io.open(tmpfile, 'w', encoding='utf-8') as fh:
+                fh.write(format_sidecar(stored))
+            mdsspath.put_path(tmpfile, os.path.join(rdir, SIDECAR), self.project, self.verbose)
+        finally:
+            shutil.rmtree(tmpdir)
+        self._keep(rdir, stored)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self.cache is not None:
+            self.cache.close()
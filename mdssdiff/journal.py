@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import io
+import json
+import threading
+from collections import OrderedDict
+
+_version = 1
+
+class Journal(object):
+    """
+    Record of the files to be copied and those which have been copied, so
+    that a run which is killed can be continued where it stopped without
+    comparing the directories again. Once open, every change is appended
+    to the journal file as a line of JSON and flushed, so the file is up to
+    date whenever the run is stopped.
+
+    pending holds the size, if known, of each file still to be copied,
+    keyed by (direction, file), finished holds the inputs whose comparison
+    was completed, dirs holds the remote directories known to exist, and
+    unsummed holds the files put whose checksums have yet to be stored.
+    dmstates holds the DMF state, where known, of each file still to get.
+    """
+
+    def __init__(self, prefix=None, project=None):
+        self.prefix = prefix
+        self.project = project
+        self.pending = OrderedDict()
+        self.finished = set()
+        self.dirs = set()
+        self.unsummed = set()
+        self.dmstates = {}
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def open(self, filename):
+        """Write the journal so far to filename, replacing it atomically, and
+        append all further changes to it"""
+        tmpname = filename + '.tmp'
+        with io.open(tmpname, 'wb') as fh:
+            fh.write(_dumps({'version': _version, 'prefix': self.prefix, 'project': self.project}))
+            for direction in sorted(set(d for d, _ in self.pending)):
+                fh.write(_dumps({'plan': direction,
+                                 'files': [self._entry(direction, file, nbytes)
+                                           for (d, file), nbytes in self.pending.items() if d == direction]}))
+            for directory in sorted(self.finished):
+                fh.write(_dumps({'finished': directory}))
+            if self.dirs:
+                fh.write(_dumps({'dirs': sorted(self.dirs)}))
+            if self.unsummed:
+                fh.write(_dumps({'unsummed': sorted(self.unsummed)}))
+        os.rename(tmpname, filename)
+        self._fh = io.open(filename, 'ab')
+
+    def plan(self, direction, files, sizes=None, dmstates=None):
+        """Add files to be copied in direction, with their sizes from the
+        dict sizes and, for files to get, their DMF states from the dict
+        dmstates where known"""
+        with self._lock:
+            files = [file for file in files if (direction, file) not in self.pending]
+            if not files:
+                return
+            for file in files:
+                self.pending[(direction, file)] = None if sizes is None else sizes.get(file)
+                if direction == 'get' and dmstates is not None and dmstates.get(file) is not None:
+                    self.dmstates[file] = dmstates[file]
+            self._write({'plan': direction,
+                         'files': [self._entry(direction, file, self.pending[(direction, file)]) for file in files]})
+
+    def _entry(self, direction, file, nbytes):
+        # [file, size], followed by the DMF state of a file to get if known
+        if direction == 'get' and file in self.dmstates:
+            return [file, nbytes, self.dmstates[file]]
+        return [file, nbytes]
+
+    def done(self, direction, file, checksum=False):
+        """Record that file has been copied in direction, and if checksum is
+        True that its checksum is still to be stored"""
+        with self._lock:
+            self.pending.pop((direction, file), None)
+            if direction == 'get':
+                self.dmstates.pop(file, None)
+            record = {'done': direction, 'file': file}
+            if checksum:
+                self.unsummed.add(file)
+                record['checksum'] = True
+            self._write(record)
+
+    def summed(self, files):
+        """Record that the checksums of files have been stored"""
+        with self._lock:
+            files = sorted(self.unsummed.intersection(files))
+            if files:
+                self.unsummed.difference_update(files)
+                self._write({'summed': files})
+
+    def finish(self, directory):
+        """Record that the comparison of the input directory is complete, and
+        all the files to copy from it are in the journal"""
+        with self._lock:
+            self.finished.add(directory)
+            self._write({'finished': directory})
+
+    def add_dirs(self, dirs):
+        """Record that the remote directories dirs exist"""
+        with self._lock:
+            dirs = sorted(set(dirs) - self.dirs)
+            if dirs:
+                self.dirs.update(dirs)
+                self._write({'dirs': dirs})
+
+    def _write(self, record):
+        if self._fh is not None:
+            self._fh.write(_dumps(record))
+            self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    @classmethod
+    def load(cls, filename):
+        """Read a journal written by a previous run. A final line which was
+        cut short when the run was killed is ignored"""
+        with io.open(filename, 'rb') as fh:
+            header = json.loads(fh.readline().decode('utf-8'))
+            if header.get('version') != _version:
+                raise ValueError('Unsupported journal version in {}: {}'.format(filename, header.get('version')))
+            journal = cls(header.get('prefix'), header.get('project'))
+            for line in fh:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if 'plan' in record:
+                    for entry in record['files']:
+                        journal.pending[(record['plan'], entry[0])] = entry[1]
+                        if len(entry) > 2:
+                            journal.dmstates[entry[0]] = entry[2]
+                elif 'done' in record:
+                    journal.pending.pop((record['done'], record['file']), None)
+                    if record['done'] == 'get':
+                        journal.dmstates.pop(record['file'], None)
+                    if record.get('checksum'):
+                        journal.unsummed.add(record['file'])
+                elif 'summed' in record:
+                    journal.unsummed.difference_update(record['summed'])
+                elif 'unsummed' in record:
+                    journal.unsummed.update(record['unsummed'])
+                elif 'finished' in record:
+                    journal.finished.add(record['finished'])
+                elif 'dirs' in record:
+                    journal.dirs.update(record['dirs'])
+        return journal
+
+def _dumps(obj):
+    return (json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8')
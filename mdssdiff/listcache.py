@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import sqlite3
+import threading
+
+_schema = """
+CREATE TABLE IF NOT EXISTS listings (
+    project TEXT NOT NULL,
+    path    TEXT NOT NULL,
+    options TEXT NOT NULL,
+    dir     TEXT NOT NULL,
+    created REAL NOT NULL,
+    listing TEXT NOT NULL,
+    PRIMARY KEY (project, path, options)
+);
+CREATE INDEX IF NOT EXISTS listings_dir ON listings (project, dir);
+"""
+
+def default_path():
+    """Return the default location of the cache file, which honours
+    $XDG_CACHE_HOME and otherwise lives in ~/.cache/mdssdiff"""
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'mdssdiff', 'listings.sqlite')
+
+class ListingCache(object):
+    """
+    Persistent cache of the output of mdss listings, stored in a SQLite
+    database and keyed by project, path and listing options. Entries older
+    than ttl seconds are ignored.
+
+    Each entry also records the remote directory whose contents it
+    describes, so that all listings affected by a change to that directory
+    can be invalidated together.
+    """
+
+    def __init__(self, path=None, ttl=3600):
+        if path is None:
+            path = default_path()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.ttl = ttl
+        # Listings may be requested from more than one thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_schema)
+            self._db.execute("DELETE FROM listings WHERE created < ?", (time.time() - ttl,))
+            self._db.commit()
+
+    @staticmethod
+    def _key(path, options):
+        path = os.path.normpath(path)
+        options = options or []
+        # A listing of path itself (-d) describes the contents of its parent
+        dir = os.path.dirname(path) if '-d' in options else path
+        return path, ' '.join(options), dir
+
+    def get(self, project, path, options=None):
+        """Return the cached listing, or None if there isn't a current one"""
+        path, options, _ = self._key(path, options)
+        with self._lock:
+            row = self._db.execute("SELECT listing FROM listings WHERE project = ? AND "
+                                   "path = ? AND options = ? AND created >= ?",
+                                   (project, path, options, time.time() - self.ttl)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, project, path, listing, options=None):
+        """Add a listing to the cache"""
+        path, options, dir = self._key(path, options)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)",
+                             (project, path, options, dir, time.time(), listing))
+            self._db.commit()
+
+    def invalidate(self, project, path, recursive=False):
+        """
+        Remove all listings of the directory path and of its contents. If
+        recursive is True also remove all listings below path
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            self._db.execute("DELETE FROM listings WHERE project = ? AND (dir = ? OR path = ?)",
+                             (project, path, path))
+            if recursive:
+                self._db.execute("DELETE FROM listings WHERE project = ? AND dir LIKE ? ESCAPE '\\'",
+                                 (project, _escape_like(path) + '/%'))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class MemoryCache(object):
+    """
+    Cache of listings kept in memory for the rest of the run, with the same
+    interface as ListingCache. Listings not in memory are looked up in the
+    optional persistent cache backing, and new listings are added to it.
+    """
+
+    def __init__(self, backing=None):
+        self.backing = backing
+        self._lock = threading.Lock()
+        self._listings = {}
+        # Keys of the listings describing each directory
+        self._bydir = {}
+
+    def get(self, project, path, options=None):
+        path, options, dir = ListingCache._key(path, options)
+        key = (project, path, options)
+        with self._lock:
+            listing = self._listings.get(key)
+        if listing is not None or self.backing is None:
+            return listing
+        listing = self.backing.get(project, path, options.split())
+        if listing is not None:
+            self._add(key, dir, listing)
+        return listing
+
+    def put(self, project, path, listing, options=None):
+        if self.backing is not None:
+            self.backing.put(project, path, listing, options)
+        path, options, dir = ListingCache._key(path, options)
+        self._add((project, path, options), dir, listing)
+
+    def _add(self, key, dir, listing):
+        with self._lock:
+            self._listings[key] = listing
+            self._bydir.setdefault((key[0], dir), set()).add(key)
+
+    def invalidate(self, project, path, recursive=False):
+        if self.backing is not None:
+            self.backing.invalidate(project, path, recursive)
+        path = os.path.normpath(path)
+        with self._lock:
+            dirs = [(project, path)]
+            if recursive:
+                below = path + '/'
+                dirs.extend(d for d in self._bydir if d[0] == project and d[1].startswith(below))
+            keys = set(key for d in dirs for key in self._bydir.pop(d, ()))
+            # A listing of path itself (-d) describes the contents of its parent
+            keys.update(key for key in self._bydir.get((project, os.path.dirname(path)), ())
+                        if key[1] == path)
+            for key in keys:
+                self._listings.pop(key, None)
+
+    def close(self):
+        if self.backing is not None:
+            self.backing.close()
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
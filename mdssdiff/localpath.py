@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import time
+
+from mdssdiff import trace
+from mdssdiff.mdsspath import FileEntry, parallel_walk
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5 needs the scandir backport
+    from scandir import scandir
+
+# A directory modified less than this many seconds before it is scanned is
+# scanned again next time, as its modification time may not change if it is
+# modified again within the same second
+_racy_seconds = 2.
+
+def walk(top, topdown=True, onerror=None, jobs=1, manifest=None):
+    """
+    Generator that yields tuples of (dname, dirnames, filenames, entries) in
+    the same order as os.walk, where entries maps each filename to a
+    mdsspath.FileEntry holding its size and modification time. Every file is
+    stat'd exactly once.
+
+    As with os.walk symbolic links to directories are included in dirnames
+    but are not descended into.
+
+    If jobs is greater than one, up to jobs directories are scanned at the
+    same time, including the stat of the files in each. As with
+    mdsspath.walk, directories are then yielded in the order their scans
+    complete, but always before (topdown) or after (not topdown) their
+    subdirectories.
+
+    If manifest is a manifest.Manifest, directories whose modification time
+    is unchanged since they were recorded in it are not scanned, and their
+    contents are taken from the manifest instead. Directories which are
+    scanned are recorded in the manifest, but are scanned again next time
+    if they were modified within _racy_seconds of being scanned. Note that
+    changing a file in place does not change the modification time of its
+    directory, so such changes are not seen until something is added to or
+    removed from the directory, or the directory is dropped from the
+    manifest.
+    """
+    if jobs > 1:
+        for path, (dirnames, filenames, entries, _) in parallel_walk(top, lambda path: _scan(path, manifest),
+                                                                     _scanned_dirs, jobs, onerror, topdown):
+            yield path, dirnames, filenames, entries
+        return
+
+    try:
+        dirnames, filenames, entries, subdirs = _scan(top, manifest)
+    except OSError as err:
+        if onerror is not None:
+            onerror(err)
+        return
+
+    if topdown:
+        yield top, dirnames, filenames, entries
+    # Iterate over dirnames rather than subdirs so the caller can prune it
+    for dname in dirnames:
+        if dname in subdirs:
+            for x in walk(os.path.join(top, dname), topdown, onerror, manifest=manifest):
+                yield x
+    if not topdown:
+        yield top, dirnames, filenames, entries
+
+def _scan(top, manifest=None):
+    """
+    As _scandir, but using and updating the record of top in manifest
+    """
+    with trace.span(top, 'local'):
+        return _scan_manifest(top, manifest)
+
+def _scan_manifest(top, manifest):
+    if manifest is None:
+        return _scandir(top)
+    # The directory is stat'd before it is scanned. Where modification times
+    # are only kept to the second, a change made during the scan may not
+    # change it, so as with git's racily clean index entries, a directory
+    # modified shortly before it was stat'd is not trusted next time
+    mtime = os.stat(top).st_mtime
+    record = manifest.get(top)
+    if record is not None and record.mtime == mtime:
+        dirnames = list(record.dirnames)
+        entries = dict((f.name, f) for f in record.files)
+        filenames = [f.name for f in record.files]
+        return dirnames, filenames, entries, set(dirnames).difference(record.links)
+    dirnames, filenames, entries, subdirs = _scandir(top)
+    if time.time() - mtime < _racy_seconds:
+        mtime = None
+    manifest.update(top, mtime, dirnames, [d for d in dirnames if d not in subdirs],
+                    [entries[f] for f in filenames])
+    return dirnames, filenames, entries, subdirs
+
+def _scandir(top):
+    """
+    Scan a single directory and return lists of subdirectories and files,
+    a dict of the FileEntry of each file, and the set of subdirectories which
+    are not links.
+    """
+    dirnames, filenames, entries = [], [], {}
+    subdirs = set()
+    it = scandir(top)
+    try:
+        for entry in it:
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                dirnames.append(entry.name)
+                try:
+                    if not entry.is_symlink():
+                        subdirs.add(entry.name)
+                except OSError:
+                    pass
+            else:
+                filenames.append(entry.name)
+                try:
+                    entries[entry.name] = FileEntry.from_stat(entry.name, entry.stat())
+                except OSError:
+                    # e.g. a broken link
+                    entries[entry.name] = FileEntry(entry.name)
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    return dirnames, filenames, entries, subdirs
+
+def _scanned_dirs(path, scanned):
+    # Only those left in dirnames which are not symbolic links
+    dirnames, _, _, subdirs = scanned
+    return [os.path.join(path, dname) for dname in dirnames if dname in subdirs]
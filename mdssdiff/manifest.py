@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import gzip
+import json
+import hashlib
+import threading
+from collections import namedtuple
+
+import mdssdiff.mdsspath as mdsspath
+from mdssdiff.mdsspath import FileEntry
+
+_version = 1
+
+# The saved state of a single directory. mtime is the modification time of
+# the directory itself, or None if it is unknown or not to be trusted, links are the entries of dirnames which are links
+# and so are not descended into, and files is a list of FileEntry
+DirRecord = namedtuple('DirRecord', ['mtime', 'dirnames', 'links', 'files'])
+
+class Manifest(object):
+    """
+    Record of the contents of a directory tree, keyed by directory path.
+    Saved to and loaded from a gzipped file with one JSON record per
+    directory.
+
+    A manifest of the local filesystem has no prefix. A snapshot of mdss
+    records the prefix and project it was taken from, and its paths are
+    relative to that prefix, so that local manifests and remote snapshots of
+    the same tree can be compared with each other.
+
+    Each directory also has a fingerprint, a hash of the name, size and
+    modification time of its files and the names and fingerprints of its
+    subdirectories. Directories with the same fingerprint in two manifests
+    have identical contents all the way down, so need not be compared.
+    Fingerprints are saved with the manifest, and recalculated as needed
+    when it is updated.
+
+    A manifest can be read and updated by several threads at once, e.g.
+    those of a parallel walk.
+    """
+
+    def __init__(self, prefix=None, project=None):
+        self.prefix = prefix
+        self.project = project
+        self.dirs = {}
+        self._fingerprints = {}
+        # Reentrant as update and fingerprint call themselves
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.dirs
+
+    def get(self, path):
+        """Return the DirRecord for path, or None"""
+        with self._lock:
+            return self.dirs.get(os.path.normpath(path))
+
+    def update(self, path, mtime, dirnames, links, files):
+        """Record the contents of directory path. Any previously recorded
+        subdirectories which no longer exist are discarded"""
+        path = os.path.normpath(path)
+        with self._lock:
+            old = self.dirs.get(path)
+            self.dirs[path] = DirRecord(mtime, list(dirnames), list(links), list(files))
+            self._invalidate(path)
+            if old is not None:
+                for dname in set(old.dirnames) - set(dirnames):
+                    self.discard(os.path.join(path, dname))
+
+    def discard(self, path):
+        """Remove path and everything below it"""
+        path = os.path.normpath(path)
+        below = path + os.sep
+        with self._lock:
+            self.dirs.pop(path, None)
+            self._invalidate(path)
+            for key in [k for k in self.dirs if k.startswith(below)]:
+                del self.dirs[key]
+                self._fingerprints.pop(key, None)
+
+    def fingerprint(self, path):
+        """Return the fingerprint of directory path, or None if it is not
+        recorded"""
+        path = os.path.normpath(path)
+        with self._lock:
+            fingerprint = self._fingerprints.get(path)
+            if fingerprint is None:
+                record = self.dirs.get(path)
+                if record is None:
+                    return None
+                h = hashlib.sha1()
+                for f in sorted(record.files, key=lambda f: f.name):
+                    h.update(u'f\0{}\0{}\0{}\n'.format(f.name, f.size, f.mtime).encode('utf-8'))
+                for d in sorted(record.dirnames):
+                    child = None if d in record.links else self.fingerprint(os.path.join(path, d))
+                    h.update(u'd\0{}\0{}\n'.format(d, child or '').encode('utf-8'))
+                fingerprint = self._fingerprints[path] = h.hexdigest()
+            return fingerprint
+
+    def _invalidate(self, path):
+        # The fingerprint of path and all of its parents depend on it
+        while path:
+            self._fingerprints.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def walk(self, top):
+        """
+        Generator that yields (dname, dirnames, filenames, entries) for top
+        and every recorded directory below it, top down, in the same form as
+        localpath.walk. Directories which are not recorded are skipped
+        """
+        stack = [os.path.normpath(top)]
+        while stack:
+            dname = stack.pop()
+            record = self.get(dname)
+            if record is None:
+                continue
+            dirnames = list(record.dirnames)
+            yield (dname, dirnames, [f.name for f in record.files],
+                   dict((f.name, f) for f in record.files))
+            stack.extend(os.path.join(dname, d) for d in reversed(dirnames) if d not in record.links)
+
+    def save(self, filename):
+        """Write the manifest to filename, replacing it atomically"""
+        tmpname = filename + '.tmp'
+        with gzip.open(tmpname, 'wb') as fh:
+            fh.write(_dumps({'version': _version, 'prefix': self.prefix, 'project': self.project}))
+            with self._lock:
+                records = sorted(self.dirs.items())
+            for path, record in records:
+                fh.write(_dumps({'path': path,
+                                 'mtime': record.mtime,
+                                 'dirs': record.dirnames,
+                                 'links': record.links,
+                                 'fp': self.fingerprint(path),
+                                 'files': [[f.name, f.size, f.mtime, f.dmstate] for f in record.files]}))
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a manifest written by save"""
+        with gzip.open(filename, 'rb') as fh:
+            header = json.loads(fh.readline().decode('utf-8'))
+            if header.get('version') != _version:
+                raise ValueError('Unsupported manifest version in {}: {}'.format(filename, header.get('version')))
+            manifest = cls(header.get('prefix'), header.get('project'))
+            for line in fh:
+                d = json.loads(line.decode('utf-8'))
+                manifest.dirs[d['path']] = DirRecord(d['mtime'], d['dirs'], d['links'],
+                                                     [FileEntry(name, False, size, mtime, dmstate)
+                                                      for name, size, mtime, dmstate in d['files']])
+                if d.get('fp') is not None:
+                    manifest._fingerprints[d['path']] = d['fp']
+        return manifest
+
+def snapshot(prefix, directory, project, recursive=False, recursive_ls=False, jobs=1, manifest=None):
+    """
+    Record the contents of directory under prefix on mdss in manifest, or in
+    a new Manifest if none is given, and return it. Only directory itself is
+    recorded unless recursive is True
+    """
+    if manifest is None:
+        manifest = Manifest(prefix, project)
+    rtop = os.path.join(prefix, directory)
+    for rdname, rdirnames, rfiles in mdsspath.walk_entries(rtop, project, recursive_ls=recursive_ls and recursive,
+                                                           jobs=jobs if recursive else 1):
+        # mdss listings do not give directory modification times
+        manifest.update(os.path.relpath(rdname, prefix), None, rdirnames, [], rfiles)
+        if not recursive:
+            break
+    return manifest
+
+def _dumps(obj):
+    return (json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8')
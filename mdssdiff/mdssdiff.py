@@ -26,20 +26,31 @@ import subprocess
 import argparse
 import shlex
 import mdssdiff.mdsspath as mdsspath
-from six.moves import zip
+import mdssdiff.listcache as listcache
+import mdssdiff.localpath as localpath
+import mdssdiff.transfer as transfer
+import mdssdiff.manifest as manifest
+import mdssdiff.checksum as checksum
+import mdssdiff.metrics as metrics
+import mdssdiff.trace as trace
+import mdssdiff.journal as journal
+from multiprocessing.pool import ThreadPool, AsyncResult
+from collections import namedtuple
+from six import StringIO
 from fnmatch import fnmatch
 
-def walk(path,project=None):
+def walk(path,project=None,recursive_ls=False,jobs=1):
     if project is None:
-        return os.walk(path)
+        return (x[0:3] for x in localpath.walk(path,jobs=jobs))
     else:
-        return mdsspath.walk(path,project)
+        return mdsspath.walk(path,project,recursive_ls=recursive_ls,jobs=jobs)
 
-def getlisting(path,project=None,recursive=False,verbose=0):
+def getlisting(path,project=None,recursive=False,verbose=0,recursive_ls=False,jobs=1):
 
     listing = set() 
 
-    for (dname, dirnames, filenames) in walk(path,project):
+    for (dname, dirnames, filenames) in walk(path,project,recursive_ls=recursive_ls and recursive,
+                                             jobs=jobs if recursive else 1):
 
         if (verbose > 0): print("Walking directory {}".format(dname))
 
@@ -64,81 +75,247 @@ def makepath(path,files):
 
 # supported_file_types = ('-','b','c','C')
 
-def diffdir(prefix, directory, project, recursive=False, verbose=0, match=None):
+# Kinds of difference found between local and remote directory trees
+MISSING_LOCAL = 'missinglocal'
+MISSING_REMOTE = 'missingremote'
+MISMATCHED_SIZE = 'mismatchedsize'
+MISMATCHED_TIME = 'mismatchedtime'
+MISMATCHED_CHECKSUM = 'mismatchedchecksum'
+
+# A single difference found by iterdiff. local and remote are the size,
+# modification time or checksum on each filesystem. For missing files they
+# are the size on the filesystem which has the file, and None on the other.
+# dmstate is the DMF state of the remote file where it has been listed
+Difference = namedtuple('Difference', ['kind', 'file', 'local', 'remote', 'dmstate'])
+Difference.__new__.__defaults__ = (None,)
+
+_headings = {
+    MISSING_LOCAL : "Missing on local filesystem:",
+    MISSING_REMOTE : "Missing on remote filesystem:",
+    MISMATCHED_SIZE : "Size does not match:",
+    MISMATCHED_TIME : "Modification time does not match:",
+    MISMATCHED_CHECKSUM : "Checksum does not match:",
+}
+
+# Order in which the kinds of difference are printed
+_kinds = (MISSING_LOCAL, MISSING_REMOTE, MISMATCHED_SIZE, MISMATCHED_TIME, MISMATCHED_CHECKSUM)
+
+def diffdir(prefix, directory, project, recursive=False, verbose=0, match=None, recursive_ls=False, jobs=1, local_jobs=1, local_manifest=None,
+            remote_snapshot=None, local_snapshot=None):
 
     missinglocal = []; missingremote = []; mismatchedsizes = {}; mismatchedtimes = {}
 
-    visited = set()
+    for diff in iterdiff(prefix, directory, project, recursive, verbose, match, recursive_ls, jobs, local_jobs, local_manifest,
+                         remote_snapshot, local_snapshot):
+        if diff.kind == MISSING_LOCAL:
+            missinglocal.append(diff.file)
+        elif diff.kind == MISSING_REMOTE:
+            missingremote.append(diff.file)
+        elif diff.kind == MISMATCHED_SIZE:
+            mismatchedsizes[diff.file] = (diff.local,diff.remote)
+        elif diff.kind == MISMATCHED_TIME:
+            mismatchedtimes[diff.file] = (diff.local,diff.remote)
 
-    # Walk local directory tree and compare to remore directory tree
-    for (dname, dirnames, filenames) in walk(directory):
+    return(missinglocal, missingremote, mismatchedsizes, mismatchedtimes)
 
-        if (verbose > 0): print("Walking local directory {}".format(dname))
+def iterdiff(prefix, directory, project, recursive=False, verbose=0, match=None, recursive_ls=False, jobs=1, local_jobs=1, local_manifest=None,
+             remote_snapshot=None, local_snapshot=None, checksums=None):
+    """
+    Generator that compares the local directory with the same path under
+    prefix on mdss, and yields a Difference for each difference as soon as
+    the directory containing it has been compared.
+
+    If local_manifest is a manifest.Manifest it is used to avoid rescanning
+    unchanged local directories, and is updated with those that changed.
+
+    If remote_snapshot is a manifest.Manifest taken with manifest.snapshot,
+    remote listings are taken from it and mdss is not used at all. Likewise
+    if local_snapshot is given the local tree is taken from it rather than
+    the filesystem, so that two snapshots can be compared. When both are
+    given, directories with the same fingerprint in each are identical and
+    are skipped along with everything below them.
+
+    If checksums is a checksum.Checksums, files with the same size and
+    modification time in both places are also compared with the checksums
+    stored on mdss when they were put there. Files with no stored checksum
+    are not compared. The checksum files themselves are never reported.
+    """
 
-        if (dname != directory and not recursive):
-            print("Skipping subdirectories of {0} :: recursive option not specified".format(dname))
-            break
+    visited = set()
 
-        visited.add(dname)
+    # Remote directories which may not correspond to a directory visited on
+    # the local filesystem. These are walked once the local walk is finished.
+    # This includes directory itself in case it does not exist locally
+    remoteonly = [directory]
 
-        localset = set(filenames)
-        rdname = os.path.join(prefix,dname)
-        _, rfiles, rsizes, rmtimes = mdsspath.mdss_listdir(rdname,project)
-        remoteset = dict(zip(rfiles,zip(rsizes,rmtimes)))
+    # Remote listings (or pending listings) which have been fetched before they
+    # are needed, keyed by normalised remote path
+    rlistings = {}
+    empty = ([], [])
 
-        for file in localset:
-            localfile = os.path.join(dname,file)
+    rdirectory = os.path.join(prefix,directory)
 
-            if match is not None and not fnmatch(localfile,match):
-                # Ignore files not matching pattern
-                if (verbose > 1): 
-                    print("Doesn't match, ignoring {}".format(localfile))
-                if file in remoteset:
-                    del(remoteset[file])
-            else:
-                if file in remoteset:
-                    remotefile = os.path.join(rdname,file)
-                    localsize = os.path.getsize(localfile)
-                    localmtime = mdsspath.localmtime(localfile)
-                    remotesize, remotemtime = remoteset[file]
-                    if (verbose > 2): print("File: {} sizes: {} (l) {} (r)".format(localfile,localsize,remotesize))
-                    if localsize != remotesize:
-                        if (verbose > 1): print("File: {} sizes differ: {} (l) {} (r)".format(localfile,localsize,remotesize))
-                        mismatchedsizes[localfile] = (localsize,remotesize)
-                    if localmtime != remotemtime:
-                        if (verbose > 1): print("File: {} modification times differ: {} (l) {} (r)".format(localfile,localmtime,remotemtime))
-                        mismatchedtimes[localfile] = (localmtime,remotemtime)
-                    del(remoteset[file])
-                else:
-                    missingremote.append(localfile)
+    pool = None
+    # Holds the listing of the entire remote tree, made with a single call,
+    # until it has been read to the end
+    rstream = []
+    prefetched = remote_snapshot is not None or (recursive and recursive_ls)
+    if remote_snapshot is not None:
+        pass
+    elif prefetched:
+        rstream.append(mdsspath.walk_entries(rdirectory, project, recursive_ls=True))
+    elif recursive and jobs > 1:
+        pool = ThreadPool(jobs)
+
+    def rlistdir(rdname):
+        key = os.path.normpath(rdname)
+        # Read the recursive listing only as far as this directory, keeping
+        # the listings of any directories passed on the way until needed
+        while key not in rlistings and rstream:
+            try:
+                rdname, rdirnames, rfiles = next(rstream[0])
+            except StopIteration:
+                del rstream[:]
+                break
+            rlistings[os.path.normpath(rdname)] = (rdirnames, rfiles)
+        if key in rlistings:
+            listing = rlistings.pop(key)
+            return listing.get() if isinstance(listing, AsyncResult) else listing
+        elif remote_snapshot is not None:
+            record = remote_snapshot.get(os.path.relpath(rdname,prefix))
+            return empty if record is None else (record.dirnames, record.files)
+        elif prefetched:
+            return empty
+        return mdsspath.mdss_scandir(rdname,project)
+
+    def rwalk(rtop):
+        if not recursive:
+            rdirnames, rfiles = rlistdir(rtop)
+            yield rtop, rdirnames, rfiles
+        elif not prefetched:
+            for x in mdsspath.walk_entries(rtop,project,jobs=jobs):
+                yield x
+        else:
+            stack = [rtop]
+            while stack:
+                rdname = stack.pop()
+                rdirnames, rfiles = rlistdir(rdname)
+                yield rdname, rdirnames, rfiles
+                stack.extend(os.path.join(rdname,d) for d in reversed(rdirnames))
+
+    if local_snapshot is not None:
+        lwalk = local_snapshot.walk(directory)
+    else:
+        lwalk = localpath.walk(directory,jobs=local_jobs if recursive else 1,manifest=local_manifest)
 
-        for file in remoteset.keys():
-            if match is not None and not fnmatch(file,match):
-                continue
-            missinglocal.append(os.path.join(dname,file))
+    try:
+        # Walk local directory tree and compare to remote directory tree
+        for (dname, dirnames, filenames, entries) in lwalk:
 
-    rdirectory = os.path.join(prefix,directory)
-    
-    # Now walk the remote directory structure to see if we've missed any directories that
-    # are present locally
-    for (rdname, rdirnames, rfilenames) in walk(rdirectory,project=project):
+            if (verbose > 0): print("Walking local directory {}".format(dname))
 
-        ldirectory = os.path.relpath(rdname,prefix)
+            if (dname != directory and not recursive):
+                print("Skipping subdirectories of {0} :: recursive option not specified".format(dname))
+                break
 
-        if (verbose > 0): print("Walking remote directory {}".format(rdname))
+            visited.add(dname)
 
-        if (ldirectory != directory and not recursive):
-            print("Skipping subdirectories of {0} :: recursive option not specified".format(dname))
-            break
+            if rstream:
+                # Visit subdirectories in the same order as the recursive
+                # listing, so it is read in step with the local walk
+                dirnames.sort()
+
+            rdname = os.path.join(prefix,dname)
+            if local_snapshot is not None and remote_snapshot is not None:
+                fingerprint = local_snapshot.fingerprint(dname)
+                if fingerprint is not None and fingerprint == remote_snapshot.fingerprint(dname):
+                    if (verbose > 1): print("Directory {} is identical, skipping".format(dname))
+                    del dirnames[:]
+                    continue
 
-        if ldirectory not in visited:
-            if (verbose > 0): print("Directory {} not found locally, adding files".format(ldirectory))
-            for file in rfilenames:
+            localset = set(filenames)
+            localset.discard(checksum.SIDECAR)
+            rdirnames, rfiles = rlistdir(rdname)
+            remoteset = dict((f.name,f) for f in rfiles)
+            sidecar = remoteset.pop(checksum.SIDECAR, None) is not None
+            # Remote entries of files which appear to be the same, to be
+            # checked with checksums
+            unchanged = []
+
+            if recursive:
+                # This listing says which subdirectories exist remotely, so only
+                # those present in both places need to be listed later
+                rdirset = set(rdirnames)
+                for d in dirnames:
+                    key = os.path.normpath(os.path.join(rdname,d))
+                    if d not in rdirset:
+                        rlistings[key] = empty
+                    elif pool is not None:
+                        rlistings[key] = pool.apply_async(mdsspath.mdss_scandir, (key, project))
+                remoteonly.extend(os.path.join(dname,d) for d in rdirnames)
+
+            for file in localset:
+                localfile = os.path.join(dname,file)
+
+                if match is not None and not fnmatch(localfile,match):
+                    # Ignore files not matching pattern
+                    if (verbose > 1): 
+                        print("Doesn't match, ignoring {}".format(localfile))
+                    if file in remoteset:
+                        del(remoteset[file])
+                else:
+                    if file in remoteset:
+                        local = entries[file]
+                        remote = remoteset[file]
+                        if (verbose > 2): print("File: {} sizes: {} (l) {} (r)".format(localfile,local.size,remote.size))
+                        if local.size != remote.size:
+                            if (verbose > 1): print("File: {} sizes differ: {} (l) {} (r)".format(localfile,local.size,remote.size))
+                            yield Difference(MISMATCHED_SIZE,localfile,local.size,remote.size,remote.dmstate)
+                        if local.mtime != remote.mtime:
+                            if (verbose > 1): print("File: {} modification times differ: {} (l) {} (r)".format(localfile,local.datetime,remote.datetime))
+                            yield Difference(MISMATCHED_TIME,localfile,local.datetime,remote.datetime,remote.dmstate)
+                        elif local.size == remote.size:
+                            unchanged.append(remote)
+                        del(remoteset[file])
+                    else:
+                        yield Difference(MISSING_REMOTE,localfile,entries[file].size,None)
+
+            # The checksum file is only fetched if listed, but its absence is
+            # noted so it is not fetched to store checksums either
+            if checksums is not None and (unchanged or not sidecar):
+                rsums = checksums.remote(rdname, sidecar)
+                lsums = checksums.local([os.path.join(dname,remote.name) for remote in unchanged if remote.name in rsums])
+                for remote in unchanged:
+                    localfile = os.path.join(dname,remote.name)
+                    if localfile in lsums and lsums[localfile] != rsums[remote.name]:
+                        if (verbose > 1): print("File: {} checksums differ: {} (l) {} (r)".format(localfile,lsums[localfile],rsums[remote.name]))
+                        yield Difference(MISMATCHED_CHECKSUM,localfile,lsums[localfile],rsums[remote.name],remote.dmstate)
+
+            for file, remote in remoteset.items():
                 if match is not None and not fnmatch(file,match):
                     continue
-                missinglocal.append(os.path.join(ldirectory,file))
+                yield Difference(MISSING_LOCAL,os.path.join(dname,file),None,remote.size,remote.dmstate)
 
-    return(missinglocal, missingremote, mismatchedsizes, mismatchedtimes)
+        # Now walk only those remote directories which were not found locally,
+        # reusing any listings already fetched above
+        for ldirectory in remoteonly:
+            if ldirectory in visited:
+                continue
+            for (rdname, rdirnames, rfiles) in rwalk(os.path.join(prefix,ldirectory)):
+                ldirectory = os.path.relpath(rdname,prefix)
+                if (verbose > 0): print("Walking remote directory {}".format(rdname))
+                if (verbose > 0): print("Directory {} not found locally, adding files".format(ldirectory))
+                for remote in rfiles:
+                    if match is not None and not fnmatch(remote.name,match):
+                        continue
+                    if remote.name == checksum.SIDECAR:
+                        continue
+                    yield Difference(MISSING_LOCAL,os.path.join(ldirectory,remote.name),None,remote.size,remote.dmstate)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for walker in rstream:
+            walker.close()
 
 def parse_args(args):
 
@@ -148,84 +325,356 @@ def parse_args(args):
     parser.add_argument("-p","--pathprefix", help="Prefix for mdss path")
     parser.add_argument("-r","--recursive", help="Recursively descend directories (default False)", action='store_true')
     parser.add_argument("-m","--match", help="Operate only on files matching filter")
+    parser.add_argument("--recursive-ls", help="List remote directories with a single recursive mdss listing, only used with --recursive (False)", action='store_true')
+    parser.add_argument("-j","--jobs", help="Number of remote directories to list concurrently when not using --recursive-ls (default 1)", type=int, default=1)
+    parser.add_argument("--local-jobs", help="Number of local directories to scan concurrently (default 1)", type=int, default=1)
+    parser.add_argument("--cache-ttl", help="Cache remote listings on disk and reuse them for this many seconds (default 0, no caching)", type=float, default=0)
+    parser.add_argument("--cache-file", help="Location of remote listing cache (default {})".format(listcache.default_path()))
+    parser.add_argument("--snapshot", help="Save a snapshot of the remote directories to this file instead of comparing them")
+    parser.add_argument("--remote-snapshot", help="Compare against a snapshot saved with --snapshot instead of mdss")
+    parser.add_argument("--parallel-inputs", help="Number of inputs to compare at the same time, sharing remote listings and copies. The output for each input is printed once it is finished (default 1)", type=int, default=1)
+    parser.add_argument("--metrics", help="Write statistics of the mdss commands run to this file, in Prometheus text format if it ends in .prom and otherwise as JSON")
+    parser.add_argument("--trace", help="Write the time taken by each directory listing, listing parse and copy to this file in Chrome trace event format")
+    parser.add_argument("--checksum", help="Also compare checksums of files with those stored on mdss, and store checksums of files copied with --copyremote (False)", action='store_true')
+    parser.add_argument("--checksum-jobs", help="Number of processes used to calculate checksums with --checksum (default 1)", type=int, default=1)
+    parser.add_argument("--hash-cache", help="Location of the cache of local file checksums (default {})".format(checksum.default_path()))
+    #
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--manifest", help="Manifest of the local directories, only those changed since it was saved are rescanned. Created if it does not exist, and updated after each run")
+    group.add_argument("--local-snapshot", help="Take the local directories from a manifest or snapshot instead of the filesystem")
     #
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-cr","--copyremote", help="Copy files from local filesyste to mdss that are missing (False)", action='store_true')
     group.add_argument("-cl","--copylocal", help="Copy files from mdss to local filesystem that are missing (False)", action='store_true')
     #
+    parser.add_argument("-t","--transfer-jobs", help="Number of files to copy concurrently with --copyremote or --copylocal (default 1)", type=int, default=1)
+    parser.add_argument("-b","--batch-size", help="Maximum number of files in the same directory to copy with a single mdss command (default 1)", type=int, default=1)
+    parser.add_argument("--recall", help="Recall files which are only on tape with a single dmget before copying them with --copylocal (False)", action='store_true')
+    parser.add_argument("--pipeline", help="Copy files in the background while directories are still being compared, with --copyremote or --copylocal (False)", action='store_true')
+    parser.add_argument("--by-size", help="Copy the largest files first, each with enough of the smallest files copied alongside it to keep the other transfer jobs busy (False)", action='store_true')
+    parser.add_argument("--bandwidth-limit", help="Start copies at an average of at most this many MiB/s (default 0, no limit)", type=float, default=0)
+    parser.add_argument("--journal", help="Record the files to copy, and each file once it has been copied, in this file so that an interrupted run can be continued with --resume")
+    parser.add_argument("--resume", help="Continue the run recorded in --journal, copying the files it had still to copy without comparing again the inputs it had finished comparing (False)", action='store_true')
     parser.add_argument("-f","--force", help="Force copying of different, following --copyremote or --copylocal (False)", action='store_true')
     parser.add_argument("inputs", help="netCDF files or directories (-r must be specified to recursively descend directories)", nargs='+')
 
     return parser.parse_args(args)
 
+def copydirection(kind, args):
+    """Return the direction in which a file with this kind of difference
+    should be copied, or None if it should not be copied"""
+    if kind == MISSING_LOCAL and args.copylocal:
+        return transfer.GET
+    elif kind == MISSING_REMOTE and args.copyremote:
+        return transfer.PUT
+    elif kind in (MISMATCHED_SIZE, MISMATCHED_TIME, MISMATCHED_CHECKSUM) and args.force:
+        if args.copyremote:
+            return transfer.PUT
+        elif args.copylocal:
+            return transfer.GET
+    return None
+
+def show(diffs, heading=None, out=None):
+    """Print diffs grouped by kind, with a heading before each group unless
+    it is the same as heading, the last one printed. Returns the last
+    heading printed"""
+    for diff in sorted(diffs, key=lambda diff: _kinds.index(diff.kind)):
+        if diff.kind != heading:
+            print(_headings[diff.kind], file=out)
+            heading = diff.kind
+        if diff.kind in (MISSING_LOCAL, MISSING_REMOTE):
+            print(diff.file, file=out)
+        else:
+            print("{} local: {} remote: {}".format(diff.file, diff.local, diff.remote), file=out)
+    return heading
+
+def submit(engine, pending, sizes=None, dmstates=None):
+    """Queue pending files for copying and empty the pending lists"""
+    for direction, files in pending.items():
+        if len(files) > 0:
+            engine.submit(direction, files, sizes, dmstates)
+        pending[direction] = []
+
 def main(args):
 
+    remote_snapshot = local_snapshot = None
+    if args.remote_snapshot is not None:
+        remote_snapshot = manifest.Manifest.load(args.remote_snapshot)
+    if args.local_snapshot is not None:
+        local_snapshot = manifest.Manifest.load(args.local_snapshot)
+        if args.copyremote or args.copylocal:
+            sys.exit("Cannot copy files when comparing against --local-snapshot")
+    if args.checksum and (remote_snapshot is not None or local_snapshot is not None):
+        sys.exit("Cannot compare checksums when comparing against snapshots")
+    if args.resume and args.journal is None:
+        sys.exit("Cannot resume without a --journal")
+
     if args.pathprefix is not None:
         prefix = args.pathprefix
+    elif remote_snapshot is not None and remote_snapshot.prefix is not None:
+        prefix = remote_snapshot.prefix
     else:
         prefix = '.'
 
-    verbose = args.verbose
-
-    if args.project is None:
+    if args.project is not None:
+        project = args.project
+    elif remote_snapshot is not None and remote_snapshot.project is not None:
+        project = remote_snapshot.project
+    else:
         project = os.environ['PROJECT']
+
+    if args.cache_ttl > 0:
+        mdsspath.listing_cache = listcache.ListingCache(args.cache_file, ttl=args.cache_ttl)
+
+    if args.parallel_inputs > 1:
+        # Keep every listing for the rest of the run, as overlapping inputs
+        # may need the same ones
+        mdsspath.listing_cache = listcache.MemoryCache(mdsspath.listing_cache)
+
+    if args.metrics is not None:
+        mdsspath.metrics = metrics.Metrics()
+
+    if args.trace is not None:
+        trace.tracer = trace.Tracer()
+
+    try:
+        run(args, prefix, project, remote_snapshot, local_snapshot)
+    finally:
+        if mdsspath.listing_cache is not None:
+            mdsspath.listing_cache.close()
+            mdsspath.listing_cache = None
+        if mdsspath.metrics is not None:
+            mdsspath.metrics.save(args.metrics)
+            mdsspath.metrics = None
+        if trace.tracer is not None:
+            trace.tracer.save(args.trace)
+            trace.tracer = None
+
+def compare(directory, args, prefix, project, engine, out=None, **kwargs):
+    """
+    Compare a single input directory with mdss, printing the differences to
+    out (default stdout) and copying files with engine as requested by args.
+    Other keyword arguments are passed to iterdiff
+    """
+    if out is None:
+        out = sys.stdout
+
+    directory = os.path.normpath(directory)
+
+    local_snapshot = kwargs.get('local_snapshot')
+    if local_snapshot is not None:
+        isdir = directory in local_snapshot
     else:
-        project = args.project
+        isdir = os.path.isdir(directory)
+
+    if isdir:
+
+        # Only the files which are to be copied are kept, along with their
+        # sizes on the filesystem they are copied from, and the DMF states
+        # of those to get, so they need not be listed again to recall them
+        missinglocal = []; missingremote = []; mismatched = set(); sizes = {}; dmstates = {}
+
+        # With --pipeline, files to be copied from the directory currently
+        # being compared, which are queued once it is finished
+        pending = {transfer.PUT: [], transfer.GET: []}
+        pendingdir = None
+
+        # Print the differences in each directory once it has been compared,
+        # grouped by kind of difference
+        heading = None
+        found = []
+        for diff in iterdiff(prefix, directory, project, 
+                    recursive=args.recursive, verbose=args.verbose, match=args.match,
+                    recursive_ls=args.recursive_ls, jobs=args.jobs, local_jobs=args.local_jobs,
+                    **kwargs):
+
+            if found and os.path.dirname(diff.file) != os.path.dirname(found[-1].file):
+                heading = show(found, heading, out)
+                found = []
+            found.append(diff)
+
+            direction = copydirection(diff.kind, args)
+            if direction is not None and diff.kind in (MISSING_LOCAL, MISSING_REMOTE, MISMATCHED_SIZE):
+                sizes[diff.file] = diff.remote if direction == transfer.GET else diff.local
+            if direction == transfer.GET:
+                dmstates[diff.file] = diff.dmstate
+            if args.pipeline and direction is not None:
+                if os.path.dirname(diff.file) != pendingdir:
+                    submit(engine, pending, sizes, dmstates)
+                    pendingdir = os.path.dirname(diff.file)
+                files = pending[direction]
+                # Size and time mismatches for the same file arrive together
+                if not files or files[-1] != diff.file:
+                    files.append(diff.file)
+            elif diff.kind == MISSING_LOCAL and args.copylocal:
+                missinglocal.append(diff.file)
+            elif diff.kind == MISSING_REMOTE and args.copyremote:
+                missingremote.append(diff.file)
+            elif diff.kind in (MISMATCHED_SIZE, MISMATCHED_TIME, MISMATCHED_CHECKSUM) and args.force:
+                mismatched.add(diff.file)
+
+        show(found, heading, out)
+        submit(engine, pending, sizes, dmstates)
+
+        forced = None
+        if args.force and mismatched:
+            forced = transfer.PUT if args.copyremote else transfer.GET if args.copylocal else None
+
+        # Every file to copy is in the journal before the input is marked
+        # as finished, and before any is copied, so a run stopped while
+        # copying can be resumed without comparing again
+        engine.plan(transfer.GET, missinglocal, sizes, dmstates)
+        engine.plan(transfer.PUT, missingremote, sizes)
+        if forced is not None:
+            engine.plan(forced, sorted(mismatched), sizes, dmstates)
+        if engine.journal is not None:
+            engine.journal.finish(directory)
+
+        if len(missinglocal) > 0:
+            print("Copying to local filesystem:", file=out)
+            engine.get(missinglocal, sizes, dmstates)
+
+        if len(missingremote) > 0:
+            print("Copying to remote filesystem:", file=out)
+            engine.put(missingremote, sizes)
+
+        if args.force:
+            # Create unique list of files to copy
+            files = sorted(mismatched)
+            if len(files) > 0:
+                if args.copyremote:
+                    print("Copying to remote filesystem", file=out)
+                    engine.put(files, sizes)
+                elif args.copylocal:
+                    print("Copying to local filesystem", file=out)
+                    engine.get(files, sizes, dmstates)
+                else:
+                    print("Option to force copying (--force) given, but neither --copyremote nor --copylocal specified", file=out)
 
-    for directory in args.inputs:
+    else:
+        print("Skipping {} :: not a directory".format(directory), file=out)
+        if engine.journal is not None:
+            engine.journal.finish(directory)
+
+def resume(engine, run_journal, pipeline=False):
+    """Copy the files which a previous run recorded in run_journal had
+    still to copy. With recall their DMF states are taken from the journal,
+    so only the directories of files whose state was not recorded are
+    listed, along with any remote directories to put files in which the
+    journal does not record as existing"""
+    pending = list(run_journal.pending.items())
+    if pending:
+        print("Resuming {} copies from journal".format(len(pending)))
+    for direction in (transfer.PUT, transfer.GET):
+        files = [file for (d, file), _ in pending if d == direction]
+        sizes = dict((file, nbytes) for (d, file), nbytes in pending if d == direction and nbytes is not None)
+        if not files:
+            continue
+        dmstates = dict((file, run_journal.dmstates[file]) for file in files
+                        if direction == transfer.GET and file in run_journal.dmstates)
+        if pipeline:
+            engine.submit(direction, files, sizes, dmstates)
+        elif direction == transfer.PUT:
+            engine.put(files, sizes)
+        else:
+            engine.get(files, sizes, dmstates)
 
-        directory = os.path.normpath(directory)
+def run(args, prefix, project, remote_snapshot=None, local_snapshot=None):
+    """Take a snapshot or compare and copy each of the inputs, once the
+    shared state has been set up by main"""
 
-        if os.path.isdir(directory):
+    verbose = args.verbose
 
-            missinglocal, missingremote, mismatchedsizes, mismatchedtimes = diffdir(prefix, directory, project, 
-                        recursive=args.recursive, verbose=args.verbose, match=args.match)
+    if args.snapshot is not None:
+        snapshot = manifest.Manifest(prefix, project)
+        for directory in args.inputs:
+            if verbose > 0: print("Taking snapshot of {}".format(os.path.join(prefix,directory)))
+            manifest.snapshot(prefix, os.path.normpath(directory), project, recursive=args.recursive,
+                              recursive_ls=args.recursive_ls, jobs=args.jobs, manifest=snapshot)
+        snapshot.save(args.snapshot)
+        return
+
+    checksums = None
+    if args.checksum:
+        checksums = checksum.Checksums(project, checksum.HashCache(args.hash_cache), jobs=args.checksum_jobs,
+                                       verbose=args.verbose)
+
+    run_journal = None
+    if args.journal is not None:
+        if args.resume and os.path.exists(args.journal):
+            run_journal = journal.Journal.load(args.journal)
+            if (run_journal.prefix, run_journal.project) != (prefix, project):
+                sys.exit("Journal {} is for prefix {} and project {}".format(args.journal, run_journal.prefix,
+                                                                            run_journal.project))
+        else:
+            run_journal = journal.Journal(prefix, project)
+        run_journal.open(args.journal)
+
+    # Shared by all copies, so remote directories are only checked once
+    engine = transfer.TransferEngine(prefix, project, jobs=args.transfer_jobs, verbose=args.verbose,
+                                     batch_size=args.batch_size, recall=args.recall, checksums=checksums,
+                                     by_size=args.by_size, bandwidth=args.bandwidth_limit * 1048576,
+                                     journal=run_journal)
+
+    local_manifest = None
+    if args.manifest is not None:
+        if os.path.exists(args.manifest):
+            local_manifest = manifest.Manifest.load(args.manifest)
+        else:
+            local_manifest = manifest.Manifest()
+
+    if args.pipeline:
+        engine.start()
+
+    inputs = args.inputs
+    if args.resume and run_journal is not None:
+        resume(engine, run_journal, args.pipeline)
+        inputs = []
+        for directory in args.inputs:
+            if os.path.normpath(directory) in run_journal.finished:
+                print("Skipping {} :: already compared".format(directory))
+            else:
+                inputs.append(directory)
+
+    diffargs = dict(local_manifest=local_manifest, remote_snapshot=remote_snapshot,
+                    local_snapshot=local_snapshot, checksums=checksums)
+
+    def compare_input(directory, out=None):
+        compare(directory, args, prefix, project, engine, out, **diffargs)
+
+    if args.parallel_inputs > 1 and len(inputs) > 1:
+        # The output of each input is kept until it is finished, and printed
+        # in the order the inputs were given
+        def buffered(directory):
+            out = StringIO()
+            compare_input(directory, out)
+            return out.getvalue()
+        pool = ThreadPool(min(args.parallel_inputs, len(inputs)))
+        try:
+            for output in pool.imap(buffered, inputs):
+                sys.stdout.write(output)
+                sys.stdout.flush()
+        finally:
+            pool.terminate()
+    else:
+        for directory in inputs:
+            compare_input(directory)
 
-            if len(missinglocal) > 0:
-                if args.copylocal:
-                    print("Copying to local filesystem:")
-                    mdsspath.remote_get(prefix,missinglocal,project,verbose=args.verbose)
-                else:
-                    print("Missing on local filesystem:")
-                for file in missinglocal:
-                    print(file)
-    
-            if len(missingremote) > 0:
-                if args.copyremote:
-                    print("Copying to remote filesystem:")
-                    mdsspath.remote_put(prefix,missingremote,project,verbose=args.verbose)
-                else:
-                    print("Missing on remote filesystem:")
-                for file in missingremote:
-                    print(file)
-
-            if len(mismatchedsizes) > 0:
-                print("Size does not match:")
-                for file in mismatchedsizes:
-                    localsize, remotesize = mismatchedsizes[file]
-                    print("{} local: {} remote: {}".format(file, localsize, remotesize))
-
-            if len(mismatchedtimes) > 0:
-                print("Modification time does not match:")
-                for file in mismatchedtimes:
-                    localmtime, remotemtime = mismatchedtimes[file]
-                    print("{} local: {} remote: {}".format(file, localmtime, remotemtime))
-
-            if args.force:
-                # Create unique list of files to copy
-                for file in set(sorted(mismatchedtimes.keys()) + sorted(mismatchedsizes.keys())):
-                    if args.copyremote:
-                        print("Copying to remote filesystem")
-                        mdsspath.remote_put(prefix,file,project,verbose=args.verbose)
-                    elif args.copylocal:
-                        print("Copying to local filesystem")
-                        mdsspath.remote_get(prefix,file,project,verbose=args.verbose)
-                    else:
-                        print("Option to force copying (--force) given, but neither --copyremote nor --copylocal specified") 
-                        break
+    if args.pipeline:
+        engine.join()
 
-        else:
-            print("Skipping {} :: not a directory".format(directory))
+    if engine.nfiles > 0 or engine.failed:
+        print(engine.summary())
+
+    if checksums is not None:
+        engine.store_checksums()
+        checksums.close()
+
+    if local_manifest is not None:
+        local_manifest.save(args.manifest)
+
+    if run_journal is not None:
+        run_journal.close()
 
 def main_argv():
     
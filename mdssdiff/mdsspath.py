@@ -1,4 +1,4 @@
-from __future__ import unicode_literals
+from __future__ import unicode_literals, absolute_import
 
 import os
 import errno
@@ -7,9 +7,15 @@ import shlex
 import subprocess
 import datetime
 import time
+import threading
 import re
-import datetime
+import calendar
+import stat as statmod
+from multiprocessing.pool import ThreadPool
 from six import StringIO
+from six.moves import queue
+
+from mdssdiff import trace
 
 _calmonths = dict( (x, i+1) for i, x in
                    enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
@@ -21,13 +27,64 @@ _mdss_get_cmd   = 'mdss -P {} get'
 _mdss_mkdir_cmd = 'mdss -P {} mkdir'
 _mdss_rm_cmd    = 'mdss -P {} rm'
 _mdss_rmdir_cmd = 'mdss -P {} rmdir'
+_mdss_dmget_cmd = 'mdss -P {} dmget'
+
+# Maximum number of files in a single dmget command
+_mdss_dmget_max_files = 1000
+
+# DMF states of files which are not on the disk cache: offline, partially
+# online, and currently being recalled
+_dmf_offline_states = ('OFL', 'PAR', 'UNM')
+
+_mdss_ls_recursive_opts = ['-R']
+
+# Optional persistent cache of listings, e.g. a listcache.ListingCache
+listing_cache = None
+
+# Optional record of every mdss command run, e.g. a metrics.Metrics
+metrics = None
+
+# Listings currently being run, so that concurrent requests for the same
+# listing share a single mdss command
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Matches the start of a long listing line, e.g. drwxr-xr-x
+_lsline = re.compile(r'[-bcdlpsCDnM][-rwxsStTlL]{9}')
 
-def walk(top, project, topdown=True, onerror=None):
+def walk(top, project, topdown=True, onerror=None, recursive_ls=False, jobs=1):
     """
     Generator that yields tuples of (root, dirs, nondirs).
 
+    If recursive_ls is True the whole tree below top is listed with a single
+    recursive mdss listing (dmls -lR) which is parsed as it is read, rather
+    than one mdss call for every directory.
+
+    Otherwise if jobs is greater than one, up to jobs directories are listed
+    concurrently. Directories are then yielded in the order their listings
+    complete rather than depth first, but a directory is always yielded
+    before (topdown) or after (not topdown) its subdirectories.
+
     Adapted from http://code.activestate.com/recipes/499334-remove-ftp-directory-walk-equivalent/
     """
+    for root, dirs, files in walk_entries(top, project, topdown, onerror, recursive_ls, jobs):
+        yield root, dirs, [f.name for f in files]
+
+def walk_entries(top, project, topdown=True, onerror=None, recursive_ls=False, jobs=1):
+    """
+    Generator that yields tuples of (root, dirs, files), where files is a
+    list of FileEntry for the non-directories, i.e. the same information
+    returned by mdss_scandir for each directory walked
+    """
+    if recursive_ls:
+        for x in _ordered(_walk_recursive_ls(top, project, onerror), topdown):
+            yield x
+        return
+    if jobs > 1:
+        for path, listing in parallel_walk(top, lambda path: mdss_scandir(path, project), _listed_dirs,
+                                           jobs, onerror, topdown):
+            yield (path,) + listing
+        return
 
     # We may not have read permission for top, in which case we can't
     # get a list of the files the directory contains.  os.path.walk
@@ -35,53 +92,301 @@ def walk(top, project, topdown=True, onerror=None):
     # minor reason when (say) a thousand readable directories are still
     # left to visit.  That logic is copied here.
     try:
-        dirs, nondirs, _, _ = mdss_listdir(top, project)
+        dirs, files = mdss_scandir(top, project)
     except os.error as err:
         if onerror is not None:
             onerror(err)
         return
 
     if topdown:
-        yield top, dirs, nondirs
+        yield top, dirs, files
     for dname in dirs:
         # This would break on non-POSIX compliant systems, but AFAIK mdss
         # is not accessible from anything but unix (POSIX) machines.
         path = os.path.join(top, dname)
         # Don't check for links, as walk does not identify links as directories
-        for x in walk(path, project, topdown, onerror):
+        for x in walk_entries(path, project, topdown, onerror):
             yield x
     if not topdown:
-        yield top, dirs, nondirs
+        yield top, dirs, files
+
+def _walk_recursive_ls(top, project, onerror=None):
+    """
+    Generator that yields (root, dirs, files) for every directory below
+    top, parsed from the output of a single recursive
+    listing. Output is consumed as it is produced, so the first directories
+    are yielded before mdss has finished listing the tree.
+    """
+    cmd = shlex.split(_mdss_ls_cmd.format(project))
+    cmd.extend(_mdss_ls_recursive_opts)
+    cmd.append(top)
+    start = time.time()
+    try:
+        # The listing process has its own copy of devnull once started
+        with open(os.devnull, 'wb') as devnull:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull)
+    except os.error as err:
+        _record('ls-recursive', start, -1)
+        if onerror is not None:
+            onerror(err)
+        return
+
+    nbytes = 0
+    try:
+        header = None
+        root = top
+        block = []
+        for line in proc.stdout:
+            nbytes += len(line)
+            line = line.decode('utf-8').rstrip('\n')
+            if line.endswith(':') and not _lsline.match(line):
+                # Start of the listing of a new directory
+                if header is None and not block:
+                    # Header for top itself
+                    header = line[:-1]
+                    continue
+                with trace.span(root, 'parse'):
+                    entries = _parse_entries(block)
+                yield (root,) + entries
+                _cache_listing(root, project, block)
+                if header is None:
+                    header = top
+                root = os.path.join(top, os.path.relpath(line[:-1], header))
+                block = []
+            elif line:
+                block.append(line)
+        with trace.span(root, 'parse'):
+            entries = _parse_entries(block)
+        yield (root,) + entries
+        _cache_listing(root, project, block)
+    finally:
+        proc.stdout.close()
+        _record('ls-recursive', start, proc.wait(), nbytes)
+        # Includes the time spent by the caller between directories
+        if trace.tracer is not None:
+            trace.tracer.add(top, 'remote', start, time.time(), {'recursive': True})
+
+def parallel_walk(top, scan, children, jobs, onerror=None, topdown=True):
+    """
+    Generator that yields (path, scan(path)) for top and every directory
+    below it, running scan on up to jobs directories at the same time.
+    Directories are yielded in the order their scans complete, but always
+    before (topdown) or after (not topdown) their subdirectories.
+
+    The subdirectories to walk are given by children(path, scanned), which
+    is only called once the directory has been yielded, so as with os.walk
+    the caller can prune them in place when topdown. OSErrors raised by scan
+    are passed to onerror if it is given, and other exceptions are raised.
+    """
+    return _ordered(_parallel_walk(top, scan, children, jobs, onerror), topdown)
+
+def _parallel_walk(top, scan, children, jobs, onerror):
+    pool = ThreadPool(jobs)
+    results = queue.Queue()
+
+    def run(path):
+        try:
+            return path, scan(path), None
+        except Exception as err:
+            return path, None, err
+
+    def submit(path):
+        pool.apply_async(run, (path,), callback=results.put)
+
+    try:
+        submit(top)
+        pending = 1
+        while pending > 0:
+            path, scanned, err = results.get()
+            pending -= 1
+            if err is not None:
+                if not isinstance(err, os.error):
+                    raise err
+                if onerror is not None:
+                    onerror(err)
+                continue
+            yield path, scanned
+            for child in children(path, scanned):
+                submit(child)
+                pending += 1
+    finally:
+        pool.terminate()
+
+def _ordered(walker, topdown):
+    """Yield the directories of a top down walk in order, or reversed if not
+    topdown, which guarantees subdirectories come before their parents"""
+    if not topdown:
+        walker = reversed(list(walker))
+    for x in walker:
+        yield x
+
+def _listed_dirs(path, listing):
+    return [os.path.join(path, dname) for dname in listing[0]]
 
 def mdss_ls(path,project,options=None):
+    with trace.span(path, 'remote'):
+        return _mdss_ls(path,project,options)
+
+def _mdss_ls(path,project,options=None):
+    if listing_cache is not None:
+        output = listing_cache.get(project,path,options)
+        if output is not None:
+            return(output)
+
+    # If another thread is already listing path, wait for its listing
+    key = (project, path, tuple(options or ()))
+    with _inflight_lock:
+        inflight = _inflight.get(key)
+        first = inflight is None
+        if first:
+            inflight = _inflight[key] = (threading.Event(), [])
+    event, result = inflight
+    if not first:
+        event.wait()
+        return result[0]
+
     cmd = shlex.split(_mdss_ls_cmd.format(project))
     if options is not None:
         cmd.extend(options)
     cmd.append(path)
+    output = ''
     try:
-        output = subprocess.check_output(cmd,stderr=subprocess.STDOUT).decode('utf-8')
+        output = _run('ls', cmd).decode('utf-8')
     except:
-        output = ''
+        pass
+    else:
+        if listing_cache is not None:
+            listing_cache.put(project,path,output,options)
+    finally:
+        result.append(output)
+        with _inflight_lock:
+            del _inflight[key]
+        event.set()
     return(output)
 
-def mdss_listdir(path, project):
+def _run(kind, cmd, nbytes=None):
+    """
+    Run an mdss command and return its output, raising CalledProcessError
+    if it fails. All mdss commands other than recursive listings, which are
+    read as they are produced, are run with this. If metrics is set the
+    command is recorded under kind, along with the number of bytes copied,
+    given by calling nbytes once the command has succeeded, or otherwise
+    the length of the output.
+    """
+    start = time.time()
+    try:
+        output = subprocess.check_output(cmd,stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as err:
+        _record(kind, start, err.returncode)
+        raise
+    except Exception:
+        _record(kind, start, -1)
+        raise
+    if metrics is not None:
+        try:
+            nbytes = len(output) if nbytes is None else nbytes()
+        except OSError:
+            nbytes = 0
+        _record(kind, start, 0, nbytes)
+    return output
+
+def _record(kind, start, status, nbytes=0):
+    if metrics is not None:
+        metrics.record(kind, time.time() - start, status, nbytes)
+
+def _cache_listing(path, project, lines):
+    """Add a listing parsed from a recursive listing to the cache"""
+    if listing_cache is not None and lines:
+        listing_cache.put(project,path,'\n'.join(lines)+'\n')
+
+def _invalidate(path, project, recursive=False):
+    """Remove cached listings affected by a change to path"""
+    if listing_cache is not None:
+        listing_cache.invalidate(project,os.path.dirname(path))
+        listing_cache.invalidate(project,path,recursive)
+
+def mdss_listdir(path, project, dmstates=None):
     """
     List the contents of the mdss path and return two tuples of filenames
     one for subdirectories, and one for non-directories (normal files and other
     stuff). 
+    If dmstates is a dict it is updated with the DMF state of each
+    non-directory, keyed by filename.
     Adapted from http://code.activestate.com/recipes/499334-remove-ftp-directory-walk-equivalent/
     """
-    dirs, nondirs, sizes, times = [], [], [], []
     listing = mdss_ls(path,project)
 
-    for line in StringIO(listing):
+    return _parse_listing(StringIO(listing), dmstates)
+
+def mdss_scandir(path, project):
+    """
+    List the contents of the mdss path and return a list of the names of
+    subdirectories, and a list of FileEntry for the non-directories
+    """
+    listing = mdss_ls(path,project)
+
+    with trace.span(path, 'parse'):
+        return _parse_entries(StringIO(listing))
+
+class FileEntry(object):
+    """
+    Compact record of a single file, from either an mdss listing or the
+    local filesystem. mtime is the modification time to minute precision
+    as integer seconds since the epoch, taken from the local time shown in
+    listings rather than UTC, so local and remote times compare directly.
+    dmstate is the DMF state of a remote file, if known.
+    """
+    __slots__ = ('name', 'isdir', 'size', 'mtime', 'dmstate')
+
+    def __init__(self, name, isdir=False, size=None, mtime=None, dmstate=None):
+        self.name = name
+        self.isdir = isdir
+        self.size = size
+        self.mtime = mtime
+        self.dmstate = dmstate
+
+    @classmethod
+    def from_stat(cls, name, st):
+        """Make a FileEntry from the result of os.stat or DirEntry.stat"""
+        return cls(name, statmod.S_ISDIR(st.st_mode), st.st_size, mtime_from_stat(st))
+
+    @property
+    def datetime(self):
+        """Modification time as a datetime object"""
+        return mtime_to_datetime(self.mtime)
+
+    def __eq__(self, other):
+        return (isinstance(other, FileEntry) and
+                all(getattr(self, a) == getattr(other, a) for a in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FileEntry({})'.format(', '.join('{}={!r}'.format(a, getattr(self, a))
+                                                for a in self.__slots__))
+
+def _parse_entries(lines):
+    """
+    Parse the lines of a single directory listing and return a list of the
+    names of subdirectories and a list of FileEntry for the non-directories
+
+    Each line is split only once, and modification times are looked up in
+    a cache as many files share the same minute.
+    """
+    dirs, files = [], []
+    mtimes = _mtime_cache
+
+    for line in lines:
         # Parse, assuming a UNIX listing
         if line.startswith("total"): continue
         # Remove trailing newline (and whitespace)
         line = line.rstrip()
         words = line.split(None, 8)
-        if len(words) < 6:
-            print >> sys.stderr, 'Warning: Error reading short line', line
+        if len(words) < 8:
+            sys.stderr.write('Warning: Error reading short line {}\n'.format(line))
             continue
 
         # Get the filename.
@@ -89,38 +394,120 @@ def mdss_listdir(path, project):
         if filename in ('.', '..'):
             continue
 
-        if isdir(line):
+        if line[0] == 'd':
             dirs.append(filename)
-        else:
-            nondirs.append(filename)
-            sizes.append(getsize(line))
-            times.append(getmtime(line))
+            continue
+
+        try:
+            size = int(words[4])
+        except ValueError:
+            size = None
+        stamp = words[5] + ' ' + words[6]
+        try:
+            mtime = mtimes[stamp]
+        except KeyError:
+            if len(mtimes) >= _mtime_cache_size:
+                mtimes.clear()
+            mtime = mtimes[stamp] = datetime_to_mtime(datetime.datetime.strptime(stamp, "%Y-%m-%d %H:%M"))
+        state = words[7] if len(words) > 8 else ''
+        dmstate = str(state[1:-1]) if state[:1] == '(' and state[-1:] == ')' else None
+        files.append(FileEntry(filename, False, size, mtime, dmstate))
+
+    return dirs, files
+
+def _parse_listing(lines, dmstates=None):
+    """
+    Parse the lines of a single directory listing and return lists of
+    subdirectories, non-directories, and the sizes and modification times
+    of the non-directories. If dmstates is a dict it is updated with the
+    DMF state of each non-directory
+    """
+    dirs, files = _parse_entries(lines)
+    if dmstates is not None:
+        dmstates.update((f.name, f.dmstate) for f in files)
+    return (dirs, [f.name for f in files], [f.size for f in files],
+            [mtime_to_datetime(f.mtime) for f in files])
 
-    return dirs, nondirs, sizes, times
+# Modification times parsed from listings, keyed by date and time string
+_mtime_cache = {}
+_mtime_cache_size = 100000
 
 def mdss_mkdir(dir, project, verbose=0):
     cmd = shlex.split(_mdss_mkdir_cmd.format(project))
     cmd.append(dir)
     if verbose > 1: print(" ".join(cmd))
-    subprocess.check_call(cmd,stderr=subprocess.STDOUT)
+    try:
+        _run('mkdir', cmd)
+    finally:
+        _invalidate(dir, project)
+
+def mdss_rm(path, project, options=None, verbose=0):
+    cmd = shlex.split(_mdss_rm_cmd.format(project))
+    if options is not None:
+        cmd.extend(options)
+    cmd.append(path)
+    if verbose > 1: print(" ".join(cmd))
+    try:
+        _run('rm', cmd)
+    finally:
+        _invalidate(path, project, recursive=True)
+
+def mdss_rmdir(dir, project, verbose=0):
+    cmd = shlex.split(_mdss_rmdir_cmd.format(project))
+    cmd.append(dir)
+    if verbose > 1: print(" ".join(cmd))
+    try:
+        _run('rmdir', cmd)
+    finally:
+        _invalidate(dir, project)
 
-def remote_put(prefix, files, project, verbose=0):
+def make_remote_dirs(prefix, dirs, project, known_dirs=None, verbose=0):
+    """
+    Make sure all of dirs exist on mdss, along with any directories between
+    them and prefix. Missing directories are created parent first, and each
+    directory is checked at most once: those known to exist are added to the
+    set known_dirs, and any already in it are not checked again.
+    """
+    if known_dirs is None:
+        known_dirs = set()
+
+    created = set()
+    for dir in _needed_dirs(prefix, dirs, known_dirs):
+        # No need to check for a directory whose parent was just created
+        if os.path.dirname(dir) in created or not isdir(dir, project):
+            mdss_mkdir(dir, project, verbose)
+            created.add(dir)
+        known_dirs.add(dir)
+
+    return known_dirs
+
+def _needed_dirs(prefix, dirs, known_dirs):
+    """Return dirs and the directories between them and prefix which are
+    not in known_dirs, parents first"""
+    top = os.path.normpath(prefix)
+    needed = set()
+    for dir in dirs:
+        dir = os.path.normpath(dir)
+        while dir not in needed and dir not in known_dirs and dir not in ('.', '/'):
+            needed.add(dir)
+            if dir == top:
+                break
+            dir = os.path.dirname(dir) or '.'
+    return sorted(needed, key=lambda d: d.count('/'))
+
+def remote_put(prefix, files, project, verbose=0, known_dirs=None):
 
     if not isinstance(files, list):
         files = [files]
 
+    # Make all the remote directories in which to put our files up front
+    rdirs = set(os.path.dirname(os.path.join(prefix,file)) for file in files)
+    make_remote_dirs(prefix, rdirs, project, known_dirs, verbose)
+
     for file in files:
-        rfile = os.path.join(prefix,file)
-        rdir = os.path.dirname(rfile)
-        # Check if we need to make a remote directory in which to put our files
-        if not isdir(rdir, project):
-            mdss_mkdir(rdir, project)
-        cmd = shlex.split(_mdss_put_cmd.format(project))
-        cmd.extend((file,rfile))
         if verbose > 0: print(file)
-        if verbose > 1: print(" ".join(cmd))
         try:
-            output = subprocess.check_output(cmd,stderr=subprocess.STDOUT)
+            put_file(prefix, file, project, verbose)
         except:
             if verbose: print("Could not copy ",file," to remote location: ",os.path.join(prefix,file))
 
@@ -130,17 +517,83 @@ def remote_get(prefix, files, project, verbose=0):
         files = [files]
 
     for file in files:
-        # Make sure there is a destination directory
-        mkdir_p(os.path.dirname(file))
-        cmd = shlex.split(_mdss_get_cmd.format(project))
-        cmd.extend([os.path.join(prefix,file),file])
         if verbose > 0: print(file)
-        if verbose > 1: print(cmd)
         try:
-            output = subprocess.check_output(cmd,stderr=subprocess.STDOUT)
+            get_file(prefix, file, project, verbose)
         except:
             if verbose > 0: print("Could not copy ",file," from remote location: ",os.path.join(prefix,file))
 
+def put_file(prefix, file, project, verbose=0):
+    """
+    Copy a single file to the same relative path under prefix on mdss. The
+    remote directory must already exist. Raises an exception on failure.
+    """
+    put_path(file, os.path.join(prefix,file), project, verbose)
+
+def put_path(path, rpath, project, verbose=0):
+    """
+    Copy the local file path to rpath on mdss. The remote directory must
+    already exist. Raises an exception on failure.
+    """
+    cmd = shlex.split(_mdss_put_cmd.format(project))
+    cmd.extend((path,rpath))
+    if verbose > 1: print(" ".join(cmd))
+    try:
+        _run('put', cmd, lambda: os.path.getsize(path))
+    finally:
+        _invalidate(rpath, project)
+
+def get_file(prefix, file, project, verbose=0):
+    """
+    Copy a single file from the same relative path under prefix on mdss,
+    making the local directory if required. Raises an exception on failure.
+    """
+    # Make sure there is a destination directory
+    if os.path.dirname(file):
+        mkdir_p(os.path.dirname(file))
+    get_path(os.path.join(prefix,file), file, project, verbose)
+
+def get_path(rpath, path, project, verbose=0):
+    """
+    Copy rpath on mdss to the local file path. Raises an exception on
+    failure.
+    """
+    cmd = shlex.split(_mdss_get_cmd.format(project))
+    cmd.extend([rpath,path])
+    if verbose > 1: print(cmd)
+    _run('get', cmd, lambda: os.path.getsize(path))
+
+def put_files(prefix, files, project, verbose=0):
+    """
+    Copy files which are all in the same directory to the same relative
+    directory under prefix on mdss with a single mdss put. The remote
+    directory must already exist. Raises an exception on failure.
+    """
+    rdir = os.path.join(prefix,os.path.dirname(files[0]))
+    cmd = shlex.split(_mdss_put_cmd.format(project))
+    cmd.extend(files)
+    cmd.append(rdir)
+    if verbose > 1: print(" ".join(cmd))
+    try:
+        _run('put', cmd, lambda: sum(os.path.getsize(file) for file in files))
+    finally:
+        _invalidate(os.path.join(prefix,files[0]), project)
+
+def get_files(prefix, files, project, verbose=0):
+    """
+    Copy files which are all in the same directory from the same relative
+    directory under prefix on mdss with a single mdss get, making the local
+    directory if required. Raises an exception on failure.
+    """
+    dir = os.path.dirname(files[0])
+    if dir:
+        mkdir_p(dir)
+    cmd = shlex.split(_mdss_get_cmd.format(project))
+    cmd.extend(os.path.join(prefix,file) for file in files)
+    cmd.append(dir or '.')
+    if verbose > 1: print(cmd)
+    _run('get', cmd, lambda: sum(os.path.getsize(file) for file in files))
+
 def mkdir_p(path):
     # http://stackoverflow.com/a/600612
     try:
@@ -218,11 +671,65 @@ def getmtime(path,project=None):
     # Get the date.
     return datetime.datetime.strptime("{} {}".format(words[5],words[6]), "%Y-%m-%d %H:%M" )
 
+def getdmstate(path,project=None):
+    """Return the DMF state of a file parsed from listing, e.g. REG (on disk
+    only), DUL (on disk and tape) or OFL (on tape only), or None if the
+    listing does not include it.
+
+    >>> getdmstate('-rw-r--r-- 1 abc123 a00 1219 2015-11-09 12:40 (OFL) data')
+    'OFL'
+    """
+    line = getls(path,project)
+    words = line.split(None, 8)
+    if len(words) < 9 or not (words[7].startswith('(') and words[7].endswith(')')):
+        return None
+    return str(words[7][1:-1])
+
+def isoffline(dmstate):
+    """Return true if a file in this DMF state must be recalled from tape
+    before it can be read."""
+    return dmstate in _dmf_offline_states
+
+def mdss_dmget(files, project, verbose=0):
+    """
+    Recall files from tape to the mdss disk cache, waiting for the recall to
+    complete. Files are requested in as few dmget commands as possible so
+    that DMF can order the recall by tape.
+    """
+    for i in range(0, len(files), _mdss_dmget_max_files):
+        cmd = shlex.split(_mdss_dmget_cmd.format(project))
+        cmd.extend(files[i:i+_mdss_dmget_max_files])
+        if verbose > 1: print(" ".join(cmd))
+        _run('dmget', cmd, lambda: 0)
+
 def localmtime(path):
     """Return last modification time given the path to a file on the
     local file system. Returned as datetime object with minute precision
     to match time resolution available from mdss."""
 
-    return datetime.datetime.fromtimestamp(os.stat(path).st_mtime).replace(second=0,microsecond=0)
+    return statmtime(os.stat(path))
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+def mtime_to_datetime(mtime):
+    """Return a FileEntry modification time as a datetime object"""
+    return None if mtime is None else _epoch + datetime.timedelta(seconds=mtime)
+
+def datetime_to_mtime(dt):
+    """Return a datetime object as a FileEntry modification time, i.e. integer
+    seconds since the epoch treating dt as if it were UTC"""
+    return calendar.timegm(dt.timetuple())
+
+def mtime_from_stat(st):
+    """Return the FileEntry modification time, to minute precision, from the
+    result of os.stat, or DirEntry.stat"""
+    return calendar.timegm(time.localtime(st.st_mtime)[:5] + (0,))
+
+def statmtime(st):
+    """Return last modification time from the result of os.stat, or
+    DirEntry.stat, as datetime object with minute precision to match time
+    resolution available from mdss."""
+
+    return datetime.datetime.fromtimestamp(st.st_mtime).replace(second=0,microsecond=0)
 
 
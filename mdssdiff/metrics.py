@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import bisect
+import threading
+
+# Upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300., 900., 3600.)
+
+class _Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.
+        self.nbytes = 0
+        self.status = {}
+        # One more bucket than BUCKETS for commands slower than all of them
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+class Metrics(object):
+    """
+    Statistics of the mdss commands run, by kind of command: how many were
+    run, a histogram of how long they took, how many bytes they listed or
+    copied, and how many finished with each exit status.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, kind, elapsed, status=0, nbytes=0):
+        """Add a command of this kind which took elapsed seconds"""
+        with self._lock:
+            stats = self._stats.get(kind)
+            if stats is None:
+                stats = self._stats[kind] = _Stats()
+            stats.count += 1
+            stats.seconds += elapsed
+            stats.nbytes += nbytes
+            stats.status[status] = stats.status.get(status, 0) + 1
+            stats.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+    def as_dict(self):
+        """
+        Return the statistics as a dict keyed by kind of command. The
+        histogram gives the number of commands which took no longer than each
+        bucket, as in Prometheus
+
+        >>> m = Metrics()
+        >>> m.record('ls', 0.2, nbytes=100)
+        >>> m.record('ls', 20., status=1)
+        >>> d = m.as_dict()['ls']
+        >>> d['count'], d['bytes'], d['status'], d['histogram']['0.25'], d['histogram']['+Inf']
+        (2, 100, {'0': 1, '1': 1}, 1, 2)
+        """
+        with self._lock:
+            result = {}
+            for kind, stats in self._stats.items():
+                cumulative, histogram = 0, {}
+                for bound, n in zip([str(b) for b in BUCKETS] + ['+Inf'], stats.buckets):
+                    cumulative += n
+                    histogram[bound] = cumulative
+                result[kind] = {'count': stats.count,
+                                'seconds': stats.seconds,
+                                'bytes': stats.nbytes,
+                                'status': dict((str(k), v) for k, v in stats.status.items()),
+                                'histogram': histogram}
+            return result
+
+    def to_json(self):
+        return json.dumps({'commands': self.as_dict()}, indent=2, sort_keys=True) + '\n'
+
+    def to_prometheus(self):
+        """Return the statistics in the Prometheus text exposition format"""
+        stats = self.as_dict()
+        kinds = sorted(stats)
+        lines = ['# HELP mdssdiff_mdss_commands_total Number of mdss commands run',
+                 '# TYPE mdssdiff_mdss_commands_total counter']
+        for kind in kinds:
+            for status, n in sorted(stats[kind]['status'].items()):
+                lines.append('mdssdiff_mdss_commands_total{{command="{}",status="{}"}} {}'.format(kind, status, n))
+        lines += ['# HELP mdssdiff_mdss_command_seconds Time taken by mdss commands',
+                  '# TYPE mdssdiff_mdss_command_seconds histogram']
+        for kind in kinds:
+            histogram = stats[kind]['histogram']
+            for bound in [str(b) for b in BUCKETS] + ['+Inf']:
+                lines.append('mdssdiff_mdss_command_seconds_bucket{{command="{}",le="{}"}} {}'.format(kind, bound, histogram[bound]))
+            lines.append('mdssdiff_mdss_command_seconds_sum{{command="{}"}} {}'.format(kind, stats[kind]['seconds']))
+            lines.append('mdssdiff_mdss_command_seconds_count{{command="{}"}} {}'.format(kind, stats[kind]['count']))
+        lines += ['# HELP mdssdiff_mdss_bytes_total Bytes listed or copied by mdss commands',
+                  '# TYPE mdssdiff_mdss_bytes_total counter']
+        for kind in kinds:
+            lines.append('mdssdiff_mdss_bytes_total{{command="{}"}} {}'.format(kind, stats[kind]['bytes']))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename):
+        """Write the statistics to filename, in the Prometheus text format if
+        it ends in .prom and otherwise as JSON. The file is replaced
+        atomically, as required by the node exporter textfile collector"""
+        text = self.to_prometheus() if filename.endswith('.prom') else self.to_json()
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            fh.write(text)
+        os.rename(tmpname, filename)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# The Tracer to which spans are added, if any
+tracer = None
+
+class Tracer(object):
+    """
+    Collects timed spans, which are saved in the Chrome trace event format
+    so they can be loaded into chrome://tracing or Perfetto
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._threads = {}
+        self.events = []
+
+    def add(self, name, cat, start, end, args=None):
+        """Add a span which ran from start to end, as returned by time.time()"""
+        ident = threading.current_thread().ident
+        with self._lock:
+            tid = self._threads.get(ident)
+            if tid is None:
+                tid = self._threads[ident] = len(self._threads) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                    'args': {'name': threading.current_thread().name}})
+            event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                     'ts': (start - self._start) * 1e6, 'dur': (end - start) * 1e6}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def save(self, filename):
+        with self._lock:
+            events = list(self.events)
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+@contextmanager
+def span(name, cat, **args):
+    """
+    Context manager which adds a span covering its body to tracer, and does
+    nothing if there is no tracer
+
+    >>> with span('listing', 'remote', path='data'):
+    ...     pass
+    """
+    if tracer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        # The tracer may have been removed while the span was open
+        current = tracer
+        if current is not None:
+            current.add(name, cat, start, time.time(), args)
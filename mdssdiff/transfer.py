@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
+import mdssdiff.mdsspath as mdsspath
+from mdssdiff import trace
+
+PUT = 'put'
+GET = 'get'
+
+TransferResult = namedtuple('TransferResult', ['direction', 'file', 'ok', 'nbytes', 'elapsed', 'error'])
+
+def sizeof_fmt(nbytes):
+    """
+    Return a human readable size
+
+    >>> sizeof_fmt(1536)
+    '1.5 KiB'
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(nbytes) < 1024. or unit == 'TiB':
+            break
+        nbytes /= 1024.
+    return '{:.0f} B'.format(nbytes) if unit == 'B' else '{:.1f} {}'.format(nbytes, unit)
+
+def duration_fmt(seconds):
+    """
+    Return a human readable duration
+
+    >>> duration_fmt(200), duration_fmt(3900)
+    ('3m20s', '1h05m')
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    elif seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+def interleave(items, size, streams=1):
+    """
+    Return items in order of size, each of the largest followed by enough
+    of the smallest to keep streams other copies busy while it is copied,
+    i.e. the smallest items totalling streams times its size, while they
+    last. Items whose size is None count as empty
+
+    >>> interleave([10, 1, 9, 4, 2, 1, 3], lambda x: x)
+    [10, 1, 1, 2, 3, 4, 9]
+    """
+    items = sorted(items, key=lambda item: size(item) or 0, reverse=True)
+    result = []
+    i, j = 0, len(items)
+    while i < j:
+        large = items[i]
+        result.append(large)
+        i += 1
+        target, total = streams * (size(large) or 0), 0
+        while i < j and total < target:
+            j -= 1
+            result.append(items[j])
+            total += size(items[j]) or 0
+    return result
+
+class Throttle(object):
+    """
+    Token bucket limiting the average rate at which files are copied to
+    rate bytes a second, with bursts of up to burst bytes. A copy cannot be
+    slowed once mdss has started it, so instead it is delayed until the
+    bytes it will copy are within the limit
+
+    >>> throttle = Throttle(100., burst=100)
+    >>> throttle.delay(50)
+    0.0
+    >>> round(throttle.delay(150), 1)
+    1.0
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = self.rate if burst is None else burst
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def delay(self, nbytes):
+        """Take nbytes from the bucket, and return the number of seconds to
+        wait before copying them"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            return max(0., -self._tokens / self.rate)
+
+class TransferEngine(object):
+    """
+    Copy files between the local filesystem and the same relative paths
+    under prefix on mdss, with up to jobs mdss put/get commands running at
+    once. A running total of the files and bytes moved is kept for all
+    transfers made with the engine.
+
+    If batch_size is greater than one, up to batch_size files in the same
+    directory are copied with a single mdss command. If that fails each
+    file in the batch is retried on its own, so that failures are still
+    attributed to individual files.
+
+    If recall is True, files to get which are only on tape are recalled to
+    the mdss disk cache with a single dmget up front. Files already on disk
+    are copied while the recall proceeds, and the recalled files after it.
+    The DMF states of the files to get can be passed to get and submit as a
+    dict keyed by file, e.g. from the differences found by iterdiff, and
+    the remote directories are only listed to find those not given.
+
+    Files can also be copied in the background: after start, lists of files
+    passed to submit are queued for jobs worker threads, and join waits for
+    all of them to be copied. With recall, the offline files from every
+    submit are recalled by a single thread, which collects them for up to
+    recall_delay seconds, or until there are enough to fill a dmget, so
+    that they are recalled in as few dmgets as possible.
+
+    If checksums is a checksum.Checksums, the checksums of the files put on
+    mdss are stored in each remote directory once all the files claimed to
+    put in it have been copied, and those of any files put since are stored
+    by store_checksums.
+
+    The sizes of the files to copy can be passed to put, get and submit as a
+    dict keyed by file, e.g. from the differences found by iterdiff, and
+    sizes of files to put are otherwise taken from the local filesystem. If
+    by_size is True each list of files is copied largest first, with the
+    smallest files copied alongside each large one. If bandwidth is given
+    copies are started at an average of at most that many bytes a second.
+    Copying which lasts longer than progress_interval seconds periodically
+    prints the projected time to finish copying the files of known size.
+
+    If journal is an open journal.Journal, every file is added to it before
+    it is copied, and marked as done once it has been copied, and the remote
+    directories known to exist are added to it and taken as known. Files put
+    whose checksums have not been stored are also recorded, and those left
+    by a previous run are stored along with the others.
+
+    The engine can be shared by several threads. Each file is only copied
+    in each direction the first time it is passed to put, get or submit, so
+    that inputs which overlap do not copy the same file twice, and no more
+    than jobs copies run at once however many threads are copying.
+    """
+
+    progress_interval = 60.
+    recall_delay = 30.
+
+    def __init__(self, prefix, project, jobs=1, verbose=0, known_dirs=None, batch_size=1, recall=False,
+                 checksums=None, by_size=False, bandwidth=None, journal=None):
+        self.prefix = prefix
+        self.project = project
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.recall = recall
+        self.verbose = verbose
+        self.checksums = checksums
+        self.by_size = by_size
+        self.journal = journal
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        # Remote directories known to exist
+        self.known_dirs = set() if known_dirs is None else known_dirs
+        if journal is not None:
+            self.known_dirs.update(journal.dirs)
+        self.nfiles = 0
+        self.nbytes = 0
+        self.failed = []
+        self.elapsed = 0.
+        self._lock = threading.Lock()
+        # Taken by every copy, whichever thread makes it
+        self._slots = threading.BoundedSemaphore(max(jobs, 1))
+        self._queue = None
+        self._workers = []
+        # Offline files submitted which are still to be recalled
+        self._to_recall = []
+        self._recall_cond = threading.Condition()
+        self._recaller = None
+        self._stopping = False
+        self._started = None
+        # Files put whose checksums have not been stored, by directory, and
+        # the number of files claimed to put in each directory not yet copied
+        self._put = OrderedDict()
+        self._unput = {}
+        # Checksums are stored one directory at a time, as each read and
+        # rewrite the remote checksum file
+        self._store_lock = threading.Lock()
+        if journal is not None and checksums is not None:
+            for file in sorted(journal.unsummed):
+                self._put.setdefault(os.path.dirname(file), []).append(file)
+        # (direction, file) for every file passed to put, get or submit
+        self._claimed = set()
+        self._dirs_lock = threading.Lock()
+        # Sizes of the files to copy where known, the total of those not yet
+        # copied, and when copying started and progress was last printed
+        self._sizes = {}
+        self.remaining = 0
+        self._first = None
+        self._last_progress = None
+
+    def put(self, files, sizes=None):
+        """Copy files from the local filesystem to mdss. Returns a list of
+        TransferResult"""
+        if not isinstance(files, list):
+            files = [files]
+        files = self._claim(PUT, files, sizes)
+        self._make_remote_dirs(files)
+        return self._run(PUT, files)
+
+    def get(self, files, sizes=None, dmstates=None):
+        """Copy files from mdss to the local filesystem. Returns a list of
+        TransferResult"""
+        if not isinstance(files, list):
+            files = [files]
+        files = self._claim(GET, files, sizes, dmstates)
+        if not self.recall:
+            return self._run(GET, files)
+
+        online, offline = self._split_offline(files, dmstates)
+        if not offline:
+            return self._run(GET, online)
+
+        if self.verbose > 0: print("Recalling {} files from tape".format(len(offline)))
+        recall = threading.Thread(target=self._dmget, args=(offline,))
+        recall.start()
+        try:
+            results = self._run(GET, online)
+        finally:
+            recall.join()
+        return results + self._run(GET, offline)
+
+    def start(self):
+        """Start the worker threads which copy files passed to submit"""
+        self._queue = queue.Queue()
+        self._started = time.time()
+        self._workers = [threading.Thread(target=self._worker) for _ in range(max(self.jobs, 1))]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        if self.recall:
+            self._stopping = False
+            self._recaller = threading.Thread(target=self._recall_worker)
+            self._recaller.daemon = True
+            self._recaller.start()
+
+    def submit(self, direction, files, sizes=None, dmstates=None):
+        """Queue files to be copied in the direction PUT or GET by the worker
+        threads, and return without waiting for them to be copied"""
+        files = self._claim(direction, files, sizes, dmstates)
+        if not files:
+            return
+        if direction == PUT:
+            self._make_remote_dirs(files)
+        elif self.recall:
+            files, offline = self._split_offline(files, dmstates)
+            if offline:
+                # Queued once they have been recalled
+                with self._recall_cond:
+                    self._to_recall.extend(offline)
+                    self._recall_cond.notify()
+        self._enqueue(direction, files)
+
+    def join(self):
+        """Wait for all submitted files to be copied and stop the workers"""
+        if self._recaller is not None:
+            with self._recall_cond:
+                self._stopping = True
+                self._recall_cond.notify()
+            self._recaller.join()
+            self._recaller = None
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.elapsed += time.time() - self._started
+        self._workers = []
+
+    def plan(self, direction, files, sizes=None, dmstates=None):
+        """Add files to the journal, if any, to be copied in direction,
+        ahead of passing them to put or get"""
+        if self.journal is None:
+            return
+        with self._lock:
+            files = [file for file in files if (direction, file) not in self._claimed]
+        self.journal.plan(direction, files, sizes, dmstates)
+
+    def _claim(self, direction, files, sizes=None, dmstates=None):
+        """Return those of files which have not been copied in direction
+        before, and record the sizes of those which are known"""
+        with self._lock:
+            new = [file for file in files if (direction, file) not in self._claimed]
+            self._claimed.update((direction, file) for file in new)
+        known = {}
+        for file in new:
+            nbytes = None if sizes is None else sizes.get(file)
+            if nbytes is None and direction == PUT:
+                try:
+                    nbytes = os.path.getsize(file)
+                except OSError:
+                    pass
+            if nbytes is not None:
+                known[file] = nbytes
+        if self.journal is not None:
+            self.journal.plan(direction, new, known, dmstates)
+        with self._lock:
+            self._sizes.update(known)
+            self.remaining += sum(known.values())
+            if direction == PUT and self.checksums is not None:
+                for file in new:
+                    dir = os.path.dirname(file)
+                    self._unput[dir] = self._unput.get(dir, 0) + 1
+            if self._first is None and new:
+                self._first = self._last_progress = time.time()
+        return new
+
+    def _make_remote_dirs(self, files):
+        rdirs = set(os.path.dirname(os.path.join(self.prefix, file)) for file in files)
+        # Checked one thread at a time so that no directory is made twice
+        with self._dirs_lock:
+            mdsspath.make_remote_dirs(self.prefix, rdirs, self.project, self.known_dirs, self.verbose)
+            if self.journal is not None:
+                self.journal.add_dirs(self.known_dirs)
+
+    def _enqueue(self, direction, files):
+        for batch in self._batches(files):
+            self._queue.put((direction, batch))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            direction, batch = item
+            for result in self._transfer_batch(direction, batch):
+                self._report(result)
+
+    def _split_offline(self, files, dmstates=None):
+        """Split files into those on the mdss disk cache and those which are
+        only on tape, using the DMF states in dmstates where given and
+        otherwise one listing per remote directory"""
+        dmstates = {} if dmstates is None else dmstates
+        online, offline = [], []
+        unknown = {}
+        for dir in sorted(set(os.path.dirname(file) for file in files if file not in dmstates)):
+            _, rfiles = mdsspath.mdss_scandir(os.path.join(self.prefix, dir), self.project)
+            unknown.update((os.path.join(dir, f.name), f.dmstate) for f in rfiles)
+        for file in files:
+            if mdsspath.isoffline(dmstates[file] if file in dmstates else unknown.get(file)):
+                offline.append(file)
+            else:
+                online.append(file)
+        return online, offline
+
+    def _recall_worker(self):
+        """Recall the offline files submitted, and queue them to be copied
+        once recalled, until join is called"""
+        while True:
+            with self._recall_cond:
+                while not self._to_recall and not self._stopping:
+                    self._recall_cond.wait()
+                # Give more files the chance to join this recall
+                deadline = time.time() + self.recall_delay
+                while (not self._stopping and len(self._to_recall) < mdsspath._mdss_dmget_max_files
+                       and time.time() < deadline):
+                    self._recall_cond.wait(max(deadline - time.time(), 0.))
+                files, self._to_recall = self._to_recall, []
+            if not files:
+                return
+            self._dmget(files, True)
+
+    def _dmget(self, files, enqueue=False):
+        try:
+            with trace.span('dmget', 'recall', files=len(files)):
+                mdsspath.mdss_dmget([os.path.join(self.prefix, file) for file in files],
+                                    self.project, self.verbose)
+        except Exception:
+            # Not fatal, each get will recall its own file
+            if self.verbose > 0: print("Could not recall files from tape, continuing")
+        if enqueue:
+            self._enqueue(GET, files)
+
+    def _run(self, direction, files):
+        start = time.time()
+        batches = self._batches(files)
+        if self.jobs > 1 and len(batches) > 1:
+            pool = ThreadPool(min(self.jobs, len(batches)))
+            try:
+                results = [self._report(r) for batch in
+                           pool.imap_unordered(lambda b: self._transfer_batch(direction, b), batches)
+                           for r in batch]
+            finally:
+                pool.terminate()
+        else:
+            results = [self._report(r) for b in batches for r in self._transfer_batch(direction, b)]
+        self.elapsed += time.time() - start
+        return results
+
+    def _batches(self, files):
+        """Split files into lists of at most batch_size files which are all
+        in the same directory, preserving the order of directories unless
+        they are ordered by size"""
+        if self.batch_size <= 1:
+            batches = [[file] for file in files]
+        else:
+            bydir = OrderedDict()
+            for file in files:
+                bydir.setdefault(os.path.dirname(file), []).append(file)
+            batches = [dirfiles[i:i+self.batch_size] for dirfiles in bydir.values()
+                       for i in range(0, len(dirfiles), self.batch_size)]
+        if self.by_size:
+            batches = interleave(batches, self._known_bytes, max(self.jobs - 1, 1))
+        return batches
+
+    def _known_bytes(self, files):
+        """Return the known size in bytes of a batch of files"""
+        return sum(self._sizes.get(file) or 0 for file in files)
+
+    def _transfer_batch(self, direction, files):
+        if self.throttle is not None:
+            # Files of unknown size are taken from the bucket once copied
+            time.sleep(self.throttle.delay(self._known_bytes(files)))
+        with self._slots:
+            return self._copy_batch(direction, files)
+
+    def _copy_batch(self, direction, files):
+        if len(files) == 1:
+            return [self._transfer(direction, files[0])]
+        start = time.time()
+        try:
+            with trace.span(os.path.dirname(files[0]) or '.', direction, files=len(files)):
+                if direction == PUT:
+                    mdsspath.put_files(self.prefix, files, self.project, self.verbose)
+                else:
+                    mdsspath.get_files(self.prefix, files, self.project, self.verbose)
+            sizes = [os.path.getsize(file) for file in files]
+        except Exception:
+            # Retry one at a time to find out which files could not be copied
+            return [self._transfer(direction, file) for file in files]
+        elapsed = (time.time() - start) / len(files)
+        return [TransferResult(direction, file, True, nbytes, elapsed, None)
+                for file, nbytes in zip(files, sizes)]
+
+    def _transfer(self, direction, file):
+        start = time.time()
+        try:
+            with trace.span(file, direction):
+                if direction == PUT:
+                    mdsspath.put_file(self.prefix, file, self.project, self.verbose)
+                else:
+                    mdsspath.get_file(self.prefix, file, self.project, self.verbose)
+            nbytes = os.path.getsize(file)
+        except Exception as err:
+            return TransferResult(direction, file, False, 0, time.time() - start, err)
+        return TransferResult(direction, file, True, nbytes, time.time() - start, None)
+
+    def _report(self, result):
+        summed = result.direction == PUT and self.checksums is not None
+        # Directory whose files have all been put
+        finished = None
+        with self._lock:
+            nbytes = self._sizes.pop(result.file, None)
+            if nbytes is not None:
+                self.remaining -= nbytes
+            elif result.ok and self.throttle is not None:
+                self.throttle.delay(result.nbytes)
+            if summed:
+                dir = os.path.dirname(result.file)
+                self._unput[dir] -= 1
+                if self._unput[dir] == 0:
+                    del self._unput[dir]
+                    finished = dir
+            if result.ok:
+                if self.journal is not None:
+                    self.journal.done(result.direction, result.file, summed)
+                self.nfiles += 1
+                self.nbytes += result.nbytes
+                if summed:
+                    self._put.setdefault(os.path.dirname(result.file), []).append(result.file)
+                if self.verbose > 0: print(result.file)
+            else:
+                self.failed.append(result.file)
+                if self.verbose > 0:
+                    location = 'to' if result.direction == PUT else 'from'
+                    print("Could not copy ",result.file," {} remote location: ".format(location),
+                          os.path.join(self.prefix,result.file))
+            now = time.time()
+            progress = self.remaining > 0 and now - self._last_progress >= self.progress_interval
+            if progress:
+                self._last_progress = now
+        if progress:
+            print(self.projection())
+        if finished is not None:
+            try:
+                self.store_checksums([finished])
+            except Exception:
+                # Tried again by the next call without dirs
+                if self.verbose > 0: print("Could not store checksums in {}, continuing".format(finished))
+        return result
+
+    def projection(self):
+        """Return a one line report of the bytes copied so far and the
+        projected time to copy the remaining files of known size, at the
+        rate achieved so far or the bandwidth limit"""
+        with self._lock:
+            nbytes, remaining = self.nbytes, self.remaining
+            elapsed = 0. if self._first is None else time.time() - self._first
+        msg = "Copied {}, {} to go".format(sizeof_fmt(nbytes), sizeof_fmt(remaining))
+        rate = nbytes / elapsed if nbytes > 0 and elapsed > 0 else None
+        if self.throttle is not None:
+            rate = self.throttle.rate if rate is None else min(rate, self.throttle.rate)
+        if rate:
+            msg += ", about {} remaining".format(duration_fmt(remaining / rate))
+        return msg
+
+    def store_checksums(self, dirs=None):
+        """Add the checksums of the files put whose checksums have not been
+        stored to those stored in each remote directory, or only in dirs"""
+        if self.checksums is None:
+            return
+        with self._store_lock:
+            with self._lock:
+                bydir = [(dir, self._put.pop(dir)) for dir in (list(self._put) if dirs is None else dirs)
+                         if dir in self._put]
+            for i, (dir, dirfiles) in enumerate(bydir):
+                # Files left by a previous run may since have been removed
+                dirfiles = [file for file in dirfiles if os.path.isfile(file)]
+                try:
+                    hashes = self.checksums.local(dirfiles)
+                    self.checksums.store(os.path.join(self.prefix, dir),
+                                         dict((os.path.basename(file), checksum) for file, checksum in hashes.items()))
+                except Exception:
+                    # Keep the files of this and the remaining directories
+                    with self._lock:
+                        for unstored, files in bydir[i:]:
+                            self._put.setdefault(unstored, []).extend(files)
+                    raise
+                if self.journal is not None:
+                    self.journal.summed(dirfiles)
+
+    def summary(self):
+        """Return a one line summary of all transfers made"""
+        msg = "Copied {} files ({}) in {:.1f}s".format(self.nfiles, sizeof_fmt(self.nbytes), self.elapsed)
+        if self.failed:
+            msg += ", {} failed".format(len(self.failed))
+        return msg
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+import sys
+import os
+import asyncio
+
+from mdssdiff import mdsspath, mdssdiff, metrics, aiomdss
+
+prefix = 'remote'
+
+@pytest.fixture
+def local(tmpdir, monkeypatch):
+    """Use local file commands in place of mdss, with a local tree in
+    tmpdir and its copy under prefix which differs from it"""
+    monkeypatch.setattr(mdsspath, '_mdss_ls_cmd', 'ls -l --time-style=+"%Y-%m-%d %H:%M ___ "')
+    monkeypatch.setattr(mdsspath, '_mdss_put_cmd', 'cp')
+    monkeypatch.setattr(mdsspath, '_mdss_get_cmd', 'cp')
+    monkeypatch.setattr(mdsspath, '_mdss_mkdir_cmd', 'mkdir')
+    monkeypatch.chdir(tmpdir)
+    for path in ('data/a', 'data/sub/b', 'data/sub/deeper/c', 'data/localonly/d'):
+        tmpdir.join(path).write('x', ensure=True)
+    for path in ('data/a', 'data/sub/b', 'data/sub/deeper/c', 'data/remotefile', 'data/remoteonly/e'):
+        tmpdir.join(prefix, path).write('x', ensure=True)
+    tmpdir.join(prefix, 'data', 'sub', 'b').write('xyz')
+    mtime = os.path.getmtime('data/a')
+    os.utime(os.path.join(prefix, 'data', 'a'), (mtime - 3600, mtime - 3600))
+    return tmpdir
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def normalise(diffs):
+    missinglocal, missingremote, sizes, times = diffs
+    return sorted(missinglocal), sorted(missingremote), sizes, times
+
+@pytest.mark.parametrize('recursive', [False, True])
+def test_diffdir(local, recursive):
+
+    session = aiomdss.Session('', limit=4)
+    diffs = run(session.diffdir(prefix, 'data', recursive=recursive))
+    assert(normalise(diffs) == normalise(mdssdiff.diffdir(prefix, 'data', '', recursive=recursive)))
+    if recursive:
+        assert(sorted(diffs[0]) == ['data/remotefile', 'data/remoteonly/e'])
+        assert(diffs[1] == ['data/localonly/d'])
+        assert(diffs[2] == {'data/sub/b': (1, 3)})
+        assert(list(diffs[3]) == ['data/a'])
+    # Only on mdss
+    diffs = run(session.diffdir(prefix, 'data/remoteonly', recursive=recursive))
+    assert(diffs == (['data/remoteonly/e'], [], {}, {}))
+
+def test_diffdir_link(local):
+
+    # Links to directories are not followed, and anything under the same
+    # name on mdss is missing locally
+    os.symlink('sub', os.path.join('data', 'link'))
+    local.join(prefix, 'data', 'link', 'f').write('x', ensure=True)
+    session = aiomdss.Session('', limit=4)
+    diffs = run(session.diffdir(prefix, 'data', recursive=True))
+    assert(normalise(diffs) == normalise(mdssdiff.diffdir(prefix, 'data', '', recursive=True)))
+    assert('data/link/f' in diffs[0])
+
+def test_shared_listing(local):
+
+    mdsspath.metrics = metrics.Metrics()
+    try:
+        session = aiomdss.Session('')
+        async def listings():
+            return await asyncio.gather(*[session.scandir(os.path.join(prefix, 'data')) for _ in range(8)])
+        results = run(listings())
+        assert(all(result == results[0] for result in results))
+        assert(mdsspath.metrics.as_dict()['ls']['count'] == 1)
+    finally:
+        mdsspath.metrics = None
+
+def test_put_get(local):
+
+    session = aiomdss.Session('', limit=2)
+    files = ['data/localonly/d', 'data/a', 'data/missing']
+    failed = run(session.remote_put(prefix, files))
+    assert([file for file, _ in failed] == ['data/missing'])
+    assert(os.path.isfile(os.path.join(prefix, 'data', 'localonly', 'd')))
+
+    local.join('data').remove()
+    failed = run(session.remote_get(prefix, ['data/remoteonly/e', 'data/sub/deeper/c']))
+    assert(failed == [])
+    assert(os.path.isfile('data/remoteonly/e') and os.path.isfile('data/sub/deeper/c'))
+
+def test_timeout(local, monkeypatch):
+
+    monkeypatch.setattr(mdsspath, '_mdss_put_cmd', '"{}" -c "import time; time.sleep(10)"'.format(sys.executable))
+    session = aiomdss.Session('', timeout=0.2)
+    with pytest.raises(asyncio.TimeoutError):
+        run(session.put('data/a', os.path.join(prefix, 'data', 'a')))
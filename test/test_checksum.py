@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+import os
+import hashlib
+
+from mdssdiff import checksum
+
+def test_sidecar():
+
+    hashes = {'a': '1'*64, 'name with spaces': '2'*64}
+    assert(checksum.parse_sidecar(checksum.format_sidecar(hashes)) == hashes)
+
+def test_local(tmpdir):
+
+    files = []
+    for i in range(4):
+        f = tmpdir.join(str(i))
+        f.write('x'*i)
+        files.append(str(f))
+    expected = dict((f, hashlib.sha256(b'x'*i).hexdigest()) for i, f in enumerate(files))
+
+    cache = checksum.HashCache(str(tmpdir.join('hashes.sqlite')))
+    sums = checksum.Checksums('', cache, jobs=2)
+    try:
+        assert(sums.local(files) == expected)
+        assert(cache.get(os.stat(files[1])) == expected[files[1]])
+        # Cached checksums are used without reading the files again
+        cache.put([(os.stat(files[1]), 'cached')])
+        assert(sums.local(files[1:2]) == {files[1]: 'cached'})
+        # Changing a file changes its key
+        tmpdir.join('1').write('y', mode='a')
+        assert(sums.local(files[1:2]) == {files[1]: hashlib.sha256(b'xy').hexdigest()})
+    finally:
+        sums.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+
+from mdssdiff import journal, transfer
+
+def test_journal(tmpdir):
+
+    filename = str(tmpdir.join('journal'))
+    j = journal.Journal('archive', 'a00')
+    j.open(filename)
+    j.plan(transfer.PUT, ['d/a', 'd/b', 'd/c'], {'d/a': 10})
+    j.plan(transfer.PUT, ['d/a'])
+    j.add_dirs(['archive', 'archive/d'])
+    j.done(transfer.PUT, 'd/b')
+    j.finish('d')
+    j.plan(transfer.GET, ['e/x'])
+
+    # Every change is on disk without closing the journal
+    loaded = journal.Journal.load(filename)
+    assert((loaded.prefix, loaded.project) == ('archive', 'a00'))
+    assert(list(loaded.pending.items()) == [((transfer.PUT, 'd/a'), 10), ((transfer.PUT, 'd/c'), None),
+                                            ((transfer.GET, 'e/x'), None)])
+    assert(loaded.finished == set(['d']) and loaded.dirs == set(['archive', 'archive/d']))
+    j.close()
+
+    # A line cut short when the run was killed is ignored
+    with open(filename, 'a') as fh:
+        fh.write('{"done":"put","fi')
+    loaded = journal.Journal.load(filename)
+    assert(len(loaded.pending) == 3)
+
+    # Reopening rewrites only what is left to do
+    loaded.open(filename)
+    loaded.done(transfer.GET, 'e/x')
+    loaded.close()
+    with open(filename) as fh:
+        assert(len(fh.readlines()) == 6)
+    assert(list(journal.Journal.load(filename).pending) == [(transfer.PUT, 'd/a'), (transfer.PUT, 'd/c')])
+
+def test_journal_checksums(tmpdir):
+
+    filename = str(tmpdir.join('journal'))
+    j = journal.Journal('archive', 'a00')
+    j.open(filename)
+    j.plan(transfer.PUT, ['d/a', 'd/b'])
+    j.done(transfer.PUT, 'd/a', checksum=True)
+    j.done(transfer.PUT, 'd/b', checksum=True)
+    j.summed(['d/a'])
+    j.close()
+
+    # Files put whose checksums were not stored are kept when reopened
+    loaded = journal.Journal.load(filename)
+    assert(loaded.unsummed == set(['d/b']) and not loaded.pending)
+    loaded.open(filename)
+    loaded.close()
+    assert(journal.Journal.load(filename).unsummed == set(['d/b']))
+
+def test_journal_dmstates(tmpdir):
+
+    filename = str(tmpdir.join('journal'))
+    j = journal.Journal('archive', 'a00')
+    j.open(filename)
+    j.plan(transfer.GET, ['e/x', 'e/y', 'e/z'], dmstates={'e/x': 'OFL', 'e/y': 'DUL', 'e/z': None})
+    j.done(transfer.GET, 'e/y')
+    j.close()
+
+    # The DMF states of files still to get are kept when reopened
+    loaded = journal.Journal.load(filename)
+    assert(loaded.dmstates == {'e/x': 'OFL'})
+    loaded.open(filename)
+    loaded.close()
+    loaded = journal.Journal.load(filename)
+    assert(loaded.dmstates == {'e/x': 'OFL'} and len(loaded.pending) == 2)
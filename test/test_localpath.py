@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+import os
+
+from mdssdiff import localpath, manifest
+
+paths = [ ["1","lala"], ["1","po"], ["1","2","Mickey"], ["1","2","Minny"], ["1","2","Pluto"], ["1","2","3","Ren"], ["1","2","3","Stimpy"] ]
+
+@pytest.fixture
+def tree(tmpdir):
+    for p in paths:
+        tmpdir.join(*p).write('x'*len(p[-1]), ensure=True)
+    # Links to directories are listed but not followed, as with os.walk
+    os.symlink(str(tmpdir.join('1','2')), str(tmpdir.join('1','link')))
+    return str(tmpdir.join('1'))
+
+def test_walk(tree):
+
+    listing = list(localpath.walk(tree))
+    assert([x[0:3] for x in listing] == list(os.walk(tree)))
+    assert([x[0:3] for x in localpath.walk(tree,topdown=False)] == list(os.walk(tree,topdown=False)))
+    for dname, dirnames, filenames, entries in listing:
+        assert(sorted(entries) == sorted(filenames))
+        for file in filenames:
+            assert(entries[file].size == len(file))
+
+def test_walk_parallel(tree):
+
+    listing = list(localpath.walk(tree))
+    parallel = list(localpath.walk(tree,jobs=4))
+    assert(sorted(x[0:3] for x in parallel) == sorted(x[0:3] for x in listing))
+    # Parents are yielded before their subdirectories
+    roots = [x[0] for x in parallel]
+    assert(roots == sorted(roots, key=len))
+    for dname, dirnames, filenames, entries in parallel:
+        for file in filenames:
+            assert(entries[file].size == len(file))
+
+def test_walk_manifest(tree):
+
+    m = manifest.Manifest()
+    listing = list(localpath.walk(tree))
+    # Directories modified just before they are recorded are not trusted
+    assert(list(localpath.walk(tree,manifest=m)) == listing)
+    assert(len(m) == 3 and all(record.mtime is None for record in m.dirs.values()))
+    for dname, _, _ in os.walk(tree):
+        os.utime(dname, (1e9, 1e9))
+    assert(list(localpath.walk(tree,manifest=m)) == listing)
+    assert(all(record.mtime == 1e9 for record in m.dirs.values()))
+
+    # Unchanged directories are taken from the manifest without scanning
+    scanned = []
+    scandir = localpath._scandir
+    def _scandir(top):
+        scanned.append(top)
+        return scandir(top)
+    localpath._scandir = _scandir
+    try:
+        assert(list(localpath.walk(tree,manifest=m)) == listing)
+        assert(list(localpath.walk(tree,manifest=m,jobs=4,topdown=True))[0] == listing[0])
+        assert(scanned == [])
+
+        # Adding a file only rescans its directory
+        newdir = os.path.join(tree,'2')
+        open(os.path.join(newdir,'Goofy'),'w').close()
+        os.utime(newdir, (0, 0))
+        changed = list(localpath.walk(tree,manifest=m))
+        assert(scanned == [newdir])
+        assert(changed == list(localpath.walk(tree)))
+    finally:
+        localpath._scandir = scandir
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+from multiprocessing.pool import ThreadPool
+
+from mdssdiff.manifest import Manifest
+from mdssdiff.mdsspath import FileEntry
+from mdssdiff import mdssdiff
+
+def test_save_load(tmpdir):
+
+    m = Manifest()
+    m.update('a', 1.5, ['b','link'], ['link'], [FileEntry('x', False, 10, 60), FileEntry('y', False, 0, 120, 'OFL')])
+    m.update('a/b', 2., [], [], [])
+    filename = str(tmpdir.join('manifest.gz'))
+    m.save(filename)
+
+    loaded = Manifest.load(filename)
+    assert(loaded.dirs == m.dirs)
+    assert(loaded.get('a/').files[1].dmstate == 'OFL')
+
+def test_update(tmpdir):
+
+    m = Manifest()
+    m.update('a', 1., ['b'], [], [])
+    m.update('a/b', 1., ['c'], [], [])
+    m.update('a/b/c', 1., [], [], [])
+    m.update('a/bc', 1., [], [], [])
+    # Removing a subdirectory drops everything recorded below it
+    m.update('a', 2., ['bc'], [], [])
+    assert(sorted(m.dirs) == ['a', 'a/bc'])
+
+def test_walk():
+
+    m = Manifest()
+    m.update('a', 1., ['b','link'], ['link'], [FileEntry('x', False, 10, 60)])
+    m.update('a/b', 1., [], [], [FileEntry('y', False, 1, 60)])
+    listing = list(m.walk('a'))
+    assert([x[0:3] for x in listing] == [('a', ['b','link'], ['x']), ('a/b', [], ['y'])])
+    assert(listing[0][3]['x'].size == 10)
+    assert(list(m.walk('missing')) == [])
+
+def test_fingerprint(tmpdir):
+
+    def tree():
+        m = Manifest()
+        m.update('a', 1., ['b','c'], [], [FileEntry('x', False, 10, 60)])
+        m.update('a/b', 1., [], [], [FileEntry('y', False, 1, 60)])
+        m.update('a/c', 1., [], [], [FileEntry('z', False, 1, 60)])
+        return m
+
+    local, remote = tree(), tree()
+    assert(local.fingerprint('a') == remote.fingerprint('a'))
+    # Directory modification times and DMF states are not part of the fingerprint
+    remote.update('a/b', 2., [], [], [FileEntry('y', False, 1, 60, 'OFL')])
+    assert(local.fingerprint('a') == remote.fingerprint('a'))
+    assert(mdssdiff.diffdir('.', 'a', None, recursive=True, remote_snapshot=remote, local_snapshot=local) == ([], [], {}, {}))
+
+    remote.update('a/c', 1., [], [], [FileEntry('z', False, 2, 60)])
+    assert(local.fingerprint('a') != remote.fingerprint('a'))
+    assert(local.fingerprint('a/b') == remote.fingerprint('a/b'))
+
+    # Fingerprints are saved, and identical subtrees are not compared
+    filename = str(tmpdir.join('remote.gz'))
+    remote.save(filename)
+    remote = Manifest.load(filename)
+    listed = []
+    get = remote.get
+    remote.get = lambda path: listed.append(path) or get(path)
+    assert(mdssdiff.diffdir('.', 'a', None, recursive=True, remote_snapshot=remote, local_snapshot=local) == ([], [], {'a/c/z': (1, 2)}, {}))
+    assert(listed == ['a', 'a/c'])
+
+def test_threads():
+
+    m = Manifest()
+    m.update('a', 1., ['b{}'.format(i) for i in range(50)], [], [])
+    # Directories are updated and discarded by several threads at once, as
+    # in a parallel walk of overlapping inputs
+    def churn(i):
+        for n in range(100):
+            m.update('a/b{}/c{}'.format(i, n), 1., [], [], [])
+            m.discard('a/b{}'.format((i + 1) % 50))
+            m.fingerprint('a')
+    pool = ThreadPool(8)
+    try:
+        pool.map(churn, range(50))
+    finally:
+        pool.terminate()
+    assert('a' in m)
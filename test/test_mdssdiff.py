@@ -31,7 +31,9 @@ import datetime, time
 
 from fnmatch import fnmatch
 
-from mdssdiff.mdssdiff import diffdir, parse_args, main
+from mdssdiff.mdssdiff import diffdir, iterdiff, parse_args, main
+from mdssdiff.mdssdiff import MISSING_LOCAL, MISSING_REMOTE, MISMATCHED_SIZE, MISMATCHED_TIME
+from mdssdiff import mdsspath, journal
 
 import pdb #; pdb.set_trace()
 
@@ -304,3 +306,114 @@ def test_match():
     assert(len(mismatchedsizes) == 0)
     assert(len(mismatchedtimes) == 0)
     assert(sorted(missinglocal) == sorted(other_files))
+
+def test_iterdiff():
+
+    # Differences are yielded one at a time, but match those from diffdir
+    missinglocal, missingremote, mismatchedsizes, mismatchedtimes = diffdir(prefix, dirtreeroot, project, recursive=True, verbose=verbose)
+    diffs = list(iterdiff(prefix, dirtreeroot, project, recursive=True, verbose=verbose))
+    assert(len(diffs) == len(missinglocal) + len(missingremote) + len(mismatchedsizes) + len(mismatchedtimes))
+    assert([d.file for d in diffs if d.kind == MISSING_LOCAL] == missinglocal)
+    assert([d.file for d in diffs if d.kind == MISSING_REMOTE] == missingremote)
+    assert(dict((d.file,(d.local,d.remote)) for d in diffs if d.kind == MISMATCHED_SIZE) == mismatchedsizes)
+    assert(dict((d.file,(d.local,d.remote)) for d in diffs if d.kind == MISMATCHED_TIME) == mismatchedtimes)
+
+def test_iterdiff_recursive_ls(monkeypatch):
+
+    if not os.path.isdir(dirtree):
+        os.makedirs(dirtree)
+    setup_files()
+    newfile = os.path.join(dirs[0],'streamed')
+    touch(newfile)
+
+    # The recursive listing is only read as far as the directory compared
+    listed = []
+    walk_entries = mdsspath.walk_entries
+    def counted(*args, **kwargs):
+        for x in walk_entries(*args, **kwargs):
+            listed.append(os.path.relpath(x[0],prefix))
+            yield x
+    monkeypatch.setattr(mdsspath, 'walk_entries', counted)
+    try:
+        diffs = iterdiff(prefix, dirtreeroot, project, recursive=True, recursive_ls=True)
+        first = next(diffs)
+        assert(first == (MISSING_REMOTE, newfile, 0, None, None))
+        assert(listed == [dirs[0]])
+        diffs = [first] + list(diffs)
+        assert(len(listed) == len(dirs))
+        assert(sorted(diffs) == sorted(iterdiff(prefix, dirtreeroot, project, recursive=True)))
+    finally:
+        os.remove(newfile)
+
+def test_grouped_output(capsys):
+
+    if not os.path.isdir(dirtree):
+        os.makedirs(dirtree)
+    setup_files()
+    # Two files in the same directory differ in both size and time
+    files = [os.path.join(*p) for p in paths[2:4]]
+    for file in files:
+        with open(file, 'a') as fh:
+            fh.write('changed')
+        touch(file, time.time() - 7200)
+    capsys.readouterr()
+    main(parse_args(shlex.split("-r -P {} -p {} {}".format(project,prefix,dirs[0]))))
+    lines = capsys.readouterr().out.splitlines()
+    # Each kind of difference is printed under a single heading
+    start = lines.index("Size does not match:")
+    assert(sorted(line.split()[0] for line in lines[start+1:start+3]) == sorted(files))
+    assert(lines[start+3] == "Modification time does not match:")
+    assert(sorted(line.split()[0] for line in lines[start+4:start+6]) == sorted(files))
+    for file in files:
+        os.remove(file)
+
+@pytest.mark.parametrize('recall', ['', '--recall'])
+def test_resume(tmpdir, monkeypatch, recall):
+
+    if not os.path.isdir(dirtree):
+        os.makedirs(dirtree)
+    setup_files()
+    files = [os.path.join(*p) for p in paths[0:2]]
+    for file in files:
+        os.remove(file)
+    journalfile = str(tmpdir.join('journal'))
+
+    # The run is stopped when it comes to copy the second file
+    get_file = mdsspath.get_file
+    def interrupted(prefix, file, project, verbose=0):
+        if file == files[1]:
+            raise KeyboardInterrupt
+        get_file(prefix, file, project, verbose)
+    monkeypatch.setattr(mdsspath, 'get_file', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        main(parse_args(shlex.split("-r -P {} -cl {} --journal {} -p {} {}".format(project,recall,journalfile,prefix,dirs[0]))))
+    assert(not os.path.isfile(files[1]))
+    run_journal = journal.Journal.load(journalfile)
+    assert(run_journal.finished == set([dirs[0]]))
+    assert(files[1] in run_journal.dmstates)
+
+    # Resuming copies the second file without listing anything
+    monkeypatch.setattr(mdsspath, 'get_file', get_file)
+    def nolisting(*args, **kwargs):
+        raise AssertionError('listed {}'.format(args))
+    monkeypatch.setattr(mdsspath, '_mdss_ls', nolisting)
+    main(parse_args(shlex.split("-r -P {} -cl {} --journal {} --resume -p {} {}".format(project,recall,journalfile,prefix,dirs[0]))))
+    assert(os.path.isfile(files[0]) and os.path.isfile(files[1]))
+    run_journal = journal.Journal.load(journalfile)
+    assert(run_journal.pending == {} and run_journal.dmstates == {})
+
+def test_pipeline():
+
+    if not os.path.isdir(dirtree):
+        os.makedirs(dirtree)
+    setup_files()
+    file = os.path.join(*paths[0])
+    os.remove(file)
+
+    # Copy back while comparing
+    main(parse_args(shlex.split("-r -P {} -cl --pipeline -t 2 -p {} {}".format(project,prefix,dirs[0]))))
+    assert(os.path.isfile(file))
+
+    missinglocal, missingremote, mismatchedsizes, mismatchedtimes = diffdir(prefix, dirtreeroot, project, recursive=True, verbose=verbose)
+    assert(len(missinglocal) == 0)
+    assert(len(missingremote) == 0)
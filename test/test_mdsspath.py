@@ -27,11 +27,22 @@ import os
 import shutil
 import shlex
 import subprocess
+import datetime
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import pdb #; pdb.set_trace()
 
 from mdssdiff import mdsspath
 from mdssdiff import mdssdiff
+from mdssdiff import listcache
+from mdssdiff import transfer
+from mdssdiff import localpath
+from mdssdiff import manifest
+from mdssdiff import checksum
+from mdssdiff import metrics
+from mdssdiff import journal
 
 dirs = ["1","2","3"]
 dirtree = os.path.join(*dirs)
@@ -58,6 +69,7 @@ except:
     mdsspath._mdss_mkdir_cmd = 'mkdir'
     mdsspath._mdss_rm_cmd    = 'rm'
     mdsspath._mdss_rmdir_cmd = 'rmdir'
+    mdsspath._mdss_dmget_cmd = 'ls'
     project=''
 
 def touch(fname, times=None):
@@ -147,3 +159,377 @@ def test_put():
 
 
 
+
+def test_walk_recursive_ls():
+
+    top = os.path.join(prefix,dirs[0])
+    listing = list(mdsspath.walk(top,project))
+    assert(len(listing) == len(dirs))
+    # A single recursive listing should give the same result as one listing
+    # per directory
+    assert(list(mdsspath.walk(top,project,recursive_ls=True)) == listing)
+    assert(sorted(mdsspath.walk(top,project,topdown=False,recursive_ls=True)) == sorted(listing))
+    assert(list(mdsspath.walk_entries(top,project,recursive_ls=True)) == list(mdsspath.walk_entries(top,project)))
+
+def test_walk_parallel():
+
+    top = os.path.join(prefix,dirs[0])
+    listing = list(mdsspath.walk(top,project))
+    assert(sorted(mdsspath.walk(top,project,jobs=4)) == sorted(listing))
+    # Parents are yielded before (or after) their subdirectories
+    roots = [root for root, _, _ in mdsspath.walk(top,project,jobs=4)]
+    assert(roots == sorted(roots, key=len))
+    roots = [root for root, _, _ in mdsspath.walk(top,project,topdown=False,jobs=4)]
+    assert(roots == sorted(roots, key=len, reverse=True))
+
+def test_listing_cache(tmpdir):
+
+    top = os.path.join(prefix,dirs[0])
+    cache = listcache.ListingCache(str(tmpdir.join('listings.sqlite')), ttl=60)
+    newfile = os.path.join(dirs[0],'uncached')
+    touch(newfile)
+    mdsspath.listing_cache = cache
+    try:
+        listing = mdsspath.mdss_listdir(top,project)
+        # Sneak a file in behind the cache's back: cached listing is unchanged
+        mdsspath.listing_cache = None
+        mdsspath.put_path(newfile,os.path.join(top,'cached'),project)
+        mdsspath.listing_cache = cache
+        assert(mdsspath.mdss_listdir(top,project) == listing)
+        # Copying a file to the directory invalidates the cached listing
+        mdsspath.remote_put(prefix,newfile,project)
+        assert(set(mdsspath.mdss_listdir(top,project)[1]) == set(listing[1]) | set(['cached','uncached']))
+        # Expired entries are ignored
+        mdsspath.listing_cache.ttl = -1
+        assert(mdsspath.listing_cache.get(project,top) is None)
+    finally:
+        cache.close()
+        mdsspath.listing_cache = None
+        os.remove(newfile)
+
+def test_memory_cache():
+
+    top = os.path.join(prefix,dirs[0])
+    newfile = os.path.join(dirs[0],'inmemory')
+    touch(newfile)
+    mdsspath.listing_cache = listcache.MemoryCache()
+    mdsspath.metrics = metrics.Metrics()
+    try:
+        # Concurrent listings of the same directory run a single command
+        pool = ThreadPool(4)
+        listings = pool.map(lambda _: mdsspath.mdss_listdir(top,project), range(8))
+        pool.terminate()
+        assert(all(listing == listings[0] for listing in listings))
+        assert(mdsspath.metrics.as_dict()['ls']['count'] == 1)
+        # Copying a file to the directory invalidates the listing
+        mdsspath.remote_put(prefix,newfile,project)
+        assert('inmemory' in mdsspath.mdss_listdir(top,project)[1])
+    finally:
+        mdsspath.listing_cache.close()
+        mdsspath.listing_cache = None
+        mdsspath.metrics = None
+        os.remove(newfile)
+
+def test_put_new_dirs():
+
+    newdir = os.path.join(dirtree,'newdir','deeper')
+    os.makedirs(newdir)
+    newfiles = [os.path.join(newdir,f) for f in ('a','b')]
+    for f in newfiles:
+        touch(f)
+    known_dirs = set()
+    mdsspath.remote_put(prefix, newfiles, project, known_dirs=known_dirs)
+    # All directories between the files and prefix are checked or made
+    rdirs = [prefix]
+    for d in newdir.split(os.sep):
+        rdirs.append(os.path.join(rdirs[-1],d))
+    assert(known_dirs == set(rdirs))
+    for f in newfiles:
+        assert(mdsspath.isfile(os.path.join(prefix,f),project))
+    # Nothing more to check once the directories are known
+    assert(mdsspath.make_remote_dirs(prefix, [os.path.join(prefix,newdir)], project, known_dirs) == known_dirs)
+    shutil.rmtree(os.path.dirname(newdir))
+
+def test_transfer_engine():
+
+    newfiles = [os.path.join(dirtree,'transfer{}'.format(i)) for i in range(4)]
+    for f in newfiles:
+        with open(f,'w') as fh:
+            fh.write('abc')
+    engine = transfer.TransferEngine(prefix, project, jobs=3)
+    results = engine.put(newfiles)
+    assert(sorted(r.file for r in results) == newfiles)
+    assert(all(r.ok for r in results))
+    for f in newfiles:
+        os.remove(f)
+    results = engine.get(newfiles + [dumbname])
+    assert(sorted(r.file for r in results if r.ok) == newfiles)
+    assert(engine.failed == [dumbname])
+    assert(engine.nfiles == 8 and engine.nbytes == 24)
+    for f in newfiles:
+        assert(os.path.isfile(f))
+
+def test_transfer_limit(monkeypatch):
+
+    newfiles = [os.path.join(dirtree,'limit{}'.format(i)) for i in range(16)]
+    for f in newfiles:
+        touch(f)
+    running = [0, 0]
+    lock = threading.Lock()
+    def put_file(prefix, file, project, verbose=0):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+    monkeypatch.setattr(mdsspath, 'put_file', put_file)
+    # Several inputs copying at once share the engine's jobs
+    engine = transfer.TransferEngine(prefix, project, jobs=2)
+    pool = ThreadPool(4)
+    try:
+        pool.map(lambda i: engine.put(newfiles[i::4]), range(4))
+    finally:
+        pool.terminate()
+    assert(engine.nfiles == len(newfiles))
+    assert(running[1] == 2)
+    for f in newfiles:
+        os.remove(f)
+
+def test_transfer_batches():
+
+    newfiles = [os.path.join(d,'batch{}'.format(i)) for d in (dirs[0],dirtree) for i in range(3)]
+    for f in newfiles:
+        with open(f,'w') as fh:
+            fh.write('abc')
+    engine = transfer.TransferEngine(prefix, project, jobs=2, batch_size=2)
+    assert(engine._batches(newfiles) == [newfiles[0:2],newfiles[2:3],newfiles[3:5],newfiles[5:6]])
+    results = engine.put(newfiles)
+    assert(sorted(r.file for r in results if r.ok) == sorted(newfiles))
+    for f in newfiles:
+        os.remove(f)
+    # A failure in a batch is attributed to the file which caused it
+    missing = os.path.join(dirs[0],'nosuchfile')
+    results = engine.get(newfiles[0:1] + [missing] + newfiles[1:])
+    assert(sorted(r.file for r in results if r.ok) == sorted(newfiles))
+    assert(engine.failed == [missing])
+    for f in newfiles:
+        assert(os.path.isfile(f))
+
+def test_transfer_by_size():
+
+    newfiles = [os.path.join(dirtree,'sized{}'.format(i)) for i in range(5)]
+    for i, f in enumerate(newfiles):
+        with open(f,'w') as fh:
+            fh.write('x' * [500, 10, 200, 20, 30][i])
+    engine = transfer.TransferEngine(prefix, project, by_size=True, bandwidth=5000)
+    results = engine.put(newfiles)
+    # The largest file is followed by all the small ones, then the next largest
+    assert([r.file for r in results] == [newfiles[i] for i in (0, 1, 3, 4, 2)])
+    assert(all(r.ok for r in results) and engine.remaining == 0)
+    for f in newfiles:
+        os.remove(f)
+    # Sizes can be given, e.g. from a listing. Copies beyond the first
+    # second's worth wait their turn
+    engine = transfer.TransferEngine(prefix, project, bandwidth=2000)
+    start = datetime.datetime.now()
+    results = engine.get(newfiles, dict((f, 600) for f in newfiles))
+    assert(all(r.ok for r in results))
+    assert((datetime.datetime.now() - start).total_seconds() > 0.3)
+    assert(engine.projection().startswith('Copied 760 B, 0 B to go'))
+
+def test_recall(monkeypatch):
+
+    newfiles = [os.path.join(dirtree,'recall{}'.format(i)) for i in range(3)]
+    for f in newfiles:
+        touch(f)
+    engine = transfer.TransferEngine(prefix, project, recall=True)
+    engine.put(newfiles)
+    for f in newfiles:
+        os.remove(f)
+    if project == '':
+        # Pretend everything is on tape
+        monkeypatch.setattr(mdsspath, '_mdss_ls_cmd', mdsspath._mdss_ls_cmd.replace('___','(OFL)'))
+    recalled = []
+    monkeypatch.setattr(mdsspath, 'mdss_dmget', lambda files, project, verbose=0: recalled.extend(files))
+    results = engine.get(newfiles)
+    assert(all(r.ok for r in results))
+    if project == '':
+        assert(sorted(recalled) == [os.path.join(prefix,f) for f in newfiles])
+    for f in newfiles:
+        assert(os.path.isfile(f))
+        os.remove(f)
+    # States which are already known are used without listing again
+    del recalled[:]
+    def nolisting(*args):
+        raise AssertionError('listed {}'.format(args))
+    monkeypatch.setattr(mdsspath, 'mdss_scandir', nolisting)
+    engine = transfer.TransferEngine(prefix, project, recall=True)
+    results = engine.get(newfiles, dmstates=dict((f, 'OFL') for f in newfiles))
+    assert(all(r.ok for r in results))
+    assert(sorted(recalled) == [os.path.join(prefix,f) for f in newfiles])
+    for f in newfiles:
+        assert(os.path.isfile(f))
+
+def test_recall_background(monkeypatch):
+
+    newfiles = [os.path.join(d,'recalled{}'.format(i)) for d in (dirs[0],dirtree) for i in range(2)]
+    for f in newfiles:
+        touch(f)
+    transfer.TransferEngine(prefix, project).put(newfiles)
+    for f in newfiles:
+        os.remove(f)
+    recalls = []
+    monkeypatch.setattr(mdsspath, 'mdss_dmget', lambda files, project, verbose=0: recalls.append(files))
+    # Offline files from each directory submitted are recalled together
+    engine = transfer.TransferEngine(prefix, project, jobs=2, recall=True)
+    engine.start()
+    engine.submit(transfer.GET, newfiles[:2], dmstates=dict((f, 'OFL') for f in newfiles))
+    engine.submit(transfer.GET, newfiles[2:], dmstates=dict((f, 'OFL') for f in newfiles))
+    engine.join()
+    assert(recalls == [[os.path.join(prefix,f) for f in newfiles]])
+    assert(engine.nfiles == len(newfiles) and not engine.failed)
+    for f in newfiles:
+        assert(os.path.isfile(f))
+
+def test_transfer_background():
+
+    newfiles = [os.path.join(d,'background{}'.format(i)) for d in (dirs[0],dirtree) for i in range(3)]
+    for f in newfiles:
+        touch(f)
+    engine = transfer.TransferEngine(prefix, project, jobs=2, batch_size=2)
+    engine.start()
+    engine.submit(transfer.PUT, newfiles[:3])
+    engine.submit(transfer.PUT, newfiles[3:])
+    engine.join()
+    assert(engine.nfiles == len(newfiles) and not engine.failed)
+    for f in newfiles:
+        assert(mdsspath.isfile(os.path.join(prefix,f),project))
+
+def test_parse_listing():
+
+    lines = ['total 12',
+             'drwxr-xr-x 2 abc123 a00 4096 2015-11-09 12:40 (REG) subdir',
+             '-rw-r--r-- 1 abc123 a00 1219 2015-11-09 12:40 (DUL) data',
+             '-rw-r--r-- 1 abc123 a00 12 2016-01-31 23:59 (OFL) name with spaces',
+             '-rw-r--r-- 1 abc123 a00 0 2016-01-31 23:59 ___ local']
+    dmstates = {}
+    dirs, nondirs, sizes, times = mdsspath._parse_listing(lines, dmstates)
+    assert(dirs == ['subdir'])
+    assert(nondirs == ['data', 'name with spaces', 'local'])
+    # Parsing everything at once gives the same as parsing each attribute
+    for line, file, size, mtime in zip(lines[2:], nondirs, sizes, times):
+        assert(size == mdsspath.getsize(line))
+        assert(mtime == mdsspath.getmtime(line))
+        assert(dmstates[file] == mdsspath.getdmstate(line))
+
+def test_file_entry():
+
+    # Local and remote entries for the same file compare equal
+    for dname, dirnames, filenames, entries in localpath.walk(dirtree):
+        rdirs, rfiles = mdsspath.mdss_scandir(os.path.join(prefix,dname),project)
+        for remote in rfiles:
+            local = entries[remote.name]
+            assert(local.size == remote.size)
+            assert(local.mtime == remote.mtime)
+            assert(local.datetime == mdsspath.localmtime(os.path.join(dname,remote.name)))
+    entry = mdsspath.FileEntry('a', size=1, mtime=0)
+    assert(entry.datetime == datetime.datetime(1970,1,1))
+    assert(mdsspath.datetime_to_mtime(entry.datetime) == 0)
+    assert(not hasattr(entry, '__dict__'))
+
+def test_snapshot(tmpdir):
+
+    snap = manifest.snapshot(prefix, dirs[0], project, recursive=True)
+    assert(sorted(snap.dirs) == sorted(os.path.relpath(root,prefix) for root, _, _ in
+                                       mdsspath.walk(os.path.join(prefix,dirs[0]),project)))
+    filename = str(tmpdir.join('snapshot.gz'))
+    snap.save(filename)
+    snap = manifest.Manifest.load(filename)
+    assert(snap.prefix == prefix)
+
+    # Comparing against the snapshot gives the same as comparing against mdss
+    live = mdssdiff.diffdir(prefix, dirs[0], project, recursive=True)
+    assert(mdssdiff.diffdir(prefix, dirs[0], project, recursive=True, remote_snapshot=snap) == live)
+    local = manifest.Manifest()
+    list(localpath.walk(dirs[0], manifest=local))
+    assert(mdssdiff.diffdir(prefix, dirs[0], project, recursive=True, remote_snapshot=snap, local_snapshot=local) == live)
+    # A snapshot compared with itself has no differences
+    assert(mdssdiff.diffdir(prefix, dirs[0], project, recursive=True, remote_snapshot=snap, local_snapshot=snap) == ([], [], {}, {}))
+
+def test_checksum(tmpdir):
+
+    sums = checksum.Checksums(project, checksum.HashCache(str(tmpdir.join('hashes.sqlite'))))
+    try:
+        dname = os.path.join(*paths[2][:-1])
+        file = os.path.join(*paths[2])
+        rdname = os.path.join(prefix,dname)
+        # The listing shows there is no checksum file, so none is fetched,
+        # either to compare or to store checksums
+        mdsspath.metrics = metrics.Metrics()
+        try:
+            list(mdssdiff.iterdiff(prefix, dname, project, checksums=sums))
+            assert(sums.remote(rdname) == {})
+            sums.store(rdname, {'other': '0'*64})
+            counts = mdsspath.metrics.as_dict()
+        finally:
+            mdsspath.metrics = None
+        assert('get' not in counts and counts['put']['count'] == 1)
+        assert(checksum.SIDECAR in mdsspath.mdss_listdir(rdname,project)[1])
+        sums.store(rdname, {paths[2][-1]: checksum.sha256(file)})
+        assert(sorted(sums.remote(rdname)) == sorted(['other', paths[2][-1]]))
+
+        # A file with the same size and time but different contents is found
+        diffs = list(mdssdiff.iterdiff(prefix, dname, project, checksums=sums))
+        assert(diffs == [])
+        sums.store(rdname, {paths[2][-1]: '0'*64})
+        diffs = list(mdssdiff.iterdiff(prefix, dname, project, checksums=sums))
+        assert([(d.kind, d.file) for d in diffs] == [(mdssdiff.MISMATCHED_CHECKSUM, file)])
+        # Leave the remote tree as it was for the other tests
+        mdsspath.mdss_rm(os.path.join(rdname,checksum.SIDECAR), project)
+
+        # Checksums are stored as soon as every file put in a directory
+        # has been copied, and the journal says which are still to store
+        newdir = os.path.join(dirtree,'summed')
+        os.makedirs(newdir)
+        newfiles = [os.path.join(newdir,'file{}'.format(i)) for i in range(3)]
+        for f in newfiles:
+            with open(f, 'w') as fh:
+                fh.write(f)
+        run_journal = journal.Journal(prefix, project)
+        run_journal.open(str(tmpdir.join('journal')))
+        engine = transfer.TransferEngine(prefix, project, checksums=sums, journal=run_journal)
+        engine.put(newfiles[:2])
+        assert(sorted(sums.remote(os.path.join(prefix,newdir))) == ['file0', 'file1'])
+        assert(run_journal.unsummed == set())
+        # A run killed before storing them leaves them in the journal
+        mdsspath.put_file(prefix, newfiles[2], project)
+        run_journal.done(transfer.PUT, newfiles[2], checksum=True)
+        assert(journal.Journal.load(str(tmpdir.join('journal'))).unsummed == set([newfiles[2]]))
+        resumed = journal.Journal.load(str(tmpdir.join('journal')))
+        transfer.TransferEngine(prefix, project, checksums=sums, journal=resumed).store_checksums()
+        assert(sorted(sums.remote(os.path.join(prefix,newdir))) == ['file0', 'file1', 'file2'])
+        assert(resumed.unsummed == set())
+        run_journal.close()
+        resumed.close()
+        mdsspath.mdss_rm(os.path.join(prefix,newdir,checksum.SIDECAR), project)
+    finally:
+        sums.close()
+
+def test_metrics(tmpdir):
+
+    mdsspath.metrics = metrics.Metrics()
+    try:
+        mdsspath.mdss_ls(prefix,project)
+        mdsspath.mdss_ls(os.path.join(prefix,dumbname),project)
+        list(mdsspath.walk(os.path.join(prefix,dirs[0]),project,recursive_ls=True))
+        mdsspath.put_file(prefix, os.path.join(*paths[2]), project)
+        stats = mdsspath.metrics.as_dict()
+    finally:
+        mdsspath.metrics = None
+    assert(stats['ls']['count'] == 2)
+    assert(stats['ls']['status']['0'] == 1)
+    assert(stats['ls']['bytes'] > 0)
+    assert(stats['ls-recursive']['count'] == 1)
+    assert(stats['put']['bytes'] == 3)
+    assert(stats['put']['histogram']['+Inf'] == 1)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+import json
+
+from mdssdiff.metrics import Metrics
+
+def test_save(tmpdir):
+
+    m = Metrics()
+    m.record('put', 0.05, nbytes=10)
+    m.record('put', 1., status=1)
+    m.record('ls', 4000.)
+
+    filename = str(tmpdir.join('metrics.json'))
+    m.save(filename)
+    with open(filename) as fh:
+        assert(json.load(fh)['commands'] == m.as_dict())
+
+    filename = str(tmpdir.join('metrics.prom'))
+    m.save(filename)
+    with open(filename) as fh:
+        lines = fh.read().splitlines()
+    assert('mdssdiff_mdss_commands_total{command="put",status="1"} 1' in lines)
+    assert('mdssdiff_mdss_command_seconds_bucket{command="put",le="0.1"} 1' in lines)
+    assert('mdssdiff_mdss_command_seconds_bucket{command="put",le="1.0"} 2' in lines)
+    assert('mdssdiff_mdss_command_seconds_bucket{command="ls",le="3600.0"} 0' in lines)
+    assert('mdssdiff_mdss_command_seconds_bucket{command="ls",le="+Inf"} 1' in lines)
+    assert('mdssdiff_mdss_bytes_total{command="put"} 10' in lines)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+import pytest
+import os
+import json
+
+from mdssdiff import trace, localpath
+
+def test_trace(tmpdir):
+
+    tmpdir.join('a','b','c').write('x', ensure=True)
+    top = str(tmpdir.join('a'))
+
+    trace.tracer = trace.Tracer()
+    try:
+        list(localpath.walk(top, jobs=2))
+        with trace.span('outer', 'test', n=1):
+            pass
+        filename = str(tmpdir.join('trace.json'))
+        trace.tracer.save(filename)
+    finally:
+        trace.tracer = None
+
+    with open(filename) as fh:
+        events = json.load(fh)['traceEvents']
+    spans = [e for e in events if e['ph'] == 'X']
+    assert(sorted(e['name'] for e in spans if e['cat'] == 'local') == [top, os.path.join(top,'b')])
+    assert([e['args'] for e in spans if e['cat'] == 'test'] == [{'n': 1}])
+    assert(all(e['dur'] >= 0 for e in spans))
+    # Every thread is named
+    assert(set(e['tid'] for e in spans) <= set(e['tid'] for e in events if e['ph'] == 'M'))